@@ -0,0 +1,27 @@
+"""
+Pack all calibration data for a camera (bias map, read noise map, dark current
+map, ISO lookup table, gain map, flat-field correction, spectral response,
+etc.) into a single calibration bundle in the `calibration` folder.
+
+`Camera.load_all_calibrations` then memory-maps the data from this bundle
+instead of loading them from separate files, as long as the other files in
+the `calibration` folder do not change. Run this script again after any
+re-calibration.
+
+Command line arguments:
+    * `folder`: folder containing camera data.
+"""
+from spectacle import load_camera, io
+from sys import argv
+
+# Get the data folder from the command line
+folder = io.path_from_input(argv)
+root = io.find_root_folder(folder)
+
+# Load Camera object
+camera = load_camera(root)
+print(f"Loaded Camera object: {camera}")
+
+# Write all available calibration data to the bundle
+save_to = camera.write_calibration_bundle()
+print(f"Saved calibration bundle with {camera.check_calibration_data()} to `{save_to}`")
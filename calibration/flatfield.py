@@ -12,6 +12,7 @@ To do:
 """
 
 import numpy as np
+from os import cpu_count
 from sys import argv
 from spectacle import io, flat, plot
 from spectacle.general import gauss_filter_multidimensional, correlation_from_covariance, uncertainty_from_covariance
@@ -48,11 +49,11 @@ print("Loaded data")
 mean = camera.correct_bias(mean)
 
 # Normalise the RGBG2 channels to a maximum of 1 each
-mean_normalised, stds_normalised = flat.normalise_RGBG2(mean, stds, camera.bayer_map)
+mean_normalised, stds_normalised = flat.normalise_RGBG2(mean, stds, camera.bayer)
 print("Normalised data")
 
 # Convolve the flat-field data with a Gaussian kernel to remove small-scale variations
-flatfield_gauss = gauss_filter_multidimensional(mean_normalised, 10)
+flatfield_gauss = gauss_filter_multidimensional(mean_normalised, 10, workers=cpu_count())
 
 # Calculate the correction factor
 correction = 1 / flatfield_gauss
@@ -69,7 +70,7 @@ correction_raw_clipped = flat.clip_data(correction_raw)
 
 # Fit a radial vignetting model
 print("Fitting...")
-parameters, covariance = flat.fit_vignette_radial(correction_clipped)
+parameters, covariance = flat.fit_vignette_radial(correction_clipped, fast=True)
 uncertainties = uncertainty_from_covariance(covariance)
 correlation = correlation_from_covariance(covariance)
 
@@ -22,7 +22,7 @@ root = io.find_root_folder(file)
 
 # Get the data
 raw_file = io.load_raw_file(file)
-exif = io.load_exif(file)
+exif = io.load_exif_fast(file)
 print("Loaded data")
 
 # Get the camera name from the root folder, then ask the user for feedback
@@ -45,8 +45,8 @@ except KeyError:
 # Camera properties
 properties = {
         "name": camera_name,
-        "manufacturer": exif["Image Make"].printable,
-        "name_internal": exif["Image Model"].printable,
+        "manufacturer": exif["Image Make"],
+        "name_internal": exif["Image Model"],
         "image_shape": raw_file.raw_image.shape,
         "raw_extension": file.suffix,
         "bias": raw_file.black_level_per_channel,
@@ -1,4 +1,43 @@
-from . import analyse, io
-from .io import load_raw_file, load_raw_image, load_raw_image_multi, load_exif, load_means, load_stds
-from .general import gauss_filter, gauss_filter_multidimensional, weighted_mean, Rsquare, RMS, symmetric_percentiles
-from .camera import Camera, load_camera
+"""
+SPECTACLE: Standardised Photographic Equipment Calibration Technique And
+CataLoguE.
+
+Submodules (e.g. `spectacle.io`) and the shortcuts below (e.g.
+`spectacle.load_camera`) are imported when they are first used, so
+`import spectacle` is fast and has no side effects.
+"""
+
+from importlib import import_module
+
+# Submodules that are available as attributes of the package
+_submodules = ["analyse", "batch", "bias_readnoise", "bundle", "calibration_plan", "camera", "camera_cache", "catalog", "container", "dark", "flat", "gain", "general", "io", "iso", "linearity", "plot", "raw", "raw2", "raw_cache", "spectral", "stack", "wavelength"]
+
+# Commonly used functions and classes, and the submodules they come from
+_shortcuts = {"load_raw_file": "io", "load_raw_image": "io", "load_raw_image_multi": "io", "load_exif": "io", "load_exif_fast": "io", "load_means": "io", "load_stds": "io",
+              "gauss_filter": "general", "gauss_filter_multidimensional": "general", "gauss_filter_fast": "general", "weighted_mean": "general", "Rsquare": "general", "RMS": "general", "symmetric_percentiles": "general",
+              "Camera": "camera", "load_camera": "camera"}
+
+__all__ = _submodules + list(_shortcuts)
+
+
+def __getattr__(name):
+    """
+    Import submodules and shortcuts when they are first used.
+    """
+    if name in _submodules:
+        value = import_module(f".{name}", __name__)
+    elif name in _shortcuts:
+        value = getattr(import_module(f".{_shortcuts[name]}", __name__), name)
+    else:
+        raise AttributeError(f"module `{__name__}` has no attribute `{name}`")
+
+    # Store the value so this function is only called once per name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """
+    List the attributes of the package, including ones not imported yet.
+    """
+    return sorted(set(globals()) | set(__all__))
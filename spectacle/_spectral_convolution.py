@@ -6,7 +6,6 @@ For more details, please see https://doi.org/10.1364/OE.391470
 """
 
 import numpy as np
-from scipy.integrate import simps
 
 
 def integrate(*args, **kwargs):
@@ -14,6 +13,7 @@ def integrate(*args, **kwargs):
     Integrate data using `scipy.integrate.simps`.
     Return 0 if an IndexError is raised.
     """
+    from scipy.integrate import simps  # Slow to import, so only done when used
     try:
         result = simps(*args, **kwargs)
     except IndexError:
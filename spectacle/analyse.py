@@ -1,12 +1,14 @@
 """
 Module for common functions in analysing camera data or calibration data.
+
+The plotting functions import matplotlib (through `plot`) and `statistics`
+imports astropy only when they are called, so importing this module is fast.
 """
 
-from . import plot, raw
-from .general import symmetric_percentiles, gauss_filter_multidimensional
+from . import raw
+from .general import symmetric_percentiles, gauss_filter_multidimensional, gauss_filter_fast
 
 import numpy as np
-from astropy.table import Table
 
 def statistics(data, prefix_column=None, prefix_column_header=""):
     """
@@ -19,6 +21,7 @@ def statistics(data, prefix_column=None, prefix_column_header=""):
 
     All other data are printed in `%.3f` format, i.e. float with 3 decimals.
     """
+    from astropy.table import Table
 
     # Calculate statistics for each element in `data`
     means               = np.mean  (data, axis=(1,2))
@@ -54,6 +57,8 @@ def plot_gauss_maps(data, bayer_data, kernel_width_RGBG2=5, **kwargs):
     Any additional **kwargs are passed to both `plot.show_image` and
     `plot.show_image_RGBG2`.
     """
+    from . import plot
+
     # Demosaick data by splitting the RGBG2 channels into separate arrays
     data_RGBG2 = raw.demosaick(bayer_data, data)
 
@@ -61,9 +66,11 @@ def plot_gauss_maps(data, bayer_data, kernel_width_RGBG2=5, **kwargs):
     # The two-dimensional mosaicked data are convolved over both axes
     # The three-dimensional demosaicked RGBG2 data are convolved over the two
     # spatial axes (1, 2), not the colour axis (0)
+    # These are only plotted, so single precision and the approximation for
+    # large kernels are sufficient
     kernel_width_mosaic = 2 * kernel_width_RGBG2
-    data_gaussed = gauss_filter_multidimensional(data, kernel_width_mosaic)
-    data_RGBG2_gaussed = gauss_filter_multidimensional(data_RGBG2, (0, kernel_width_RGBG2, kernel_width_RGBG2))
+    data_gaussed = gauss_filter_fast(data, kernel_width_mosaic, approximate=True)
+    data_RGBG2_gaussed = gauss_filter_fast(data_RGBG2, (0, kernel_width_RGBG2, kernel_width_RGBG2), approximate=True)
 
     plot.show_image(data_gaussed, **kwargs)
     plot.show_image_RGBG2(data_RGBG2_gaussed, **kwargs)
@@ -76,6 +83,7 @@ def plot_histogram_RGB(data, bayer_data, **kwargs):
 
     Any additional **kwargs are passed to `plot.histogram_RGB`.
     """
+    from . import plot
 
     # Demosaick data by splitting the RGBG2 channels into separate arrays
     data_RGBG2 = raw.demosaick(bayer_data, data)
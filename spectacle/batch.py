@@ -0,0 +1,146 @@
+"""
+Code relating to batch calibration, which applies the calibration of a camera
+to many RAW images at once using a pool of worker processes.
+
+Each worker loads the Camera and its calibration data once (memory-mapped
+from the calibration bundle, if available), then for each image reads the
+ISO speed and exposure time from the EXIF data, calibrates the image data,
+splits them into RGBG2 channels (optionally converting them to XYZ), and
+saves the result. The main process only keeps a limited number of images in
+progress at any time, so the memory use does not depend on the number of
+images.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from os import makedirs
+from time import perf_counter
+from . import io
+
+# Stages of the calibration of each image, as reported in the timing statistics
+stages = ["exif", "load", "calibrate", "demosaick", "convert", "save"]
+
+# Output formats
+outputs = ["RGBG2", "XYZ"]
+
+# Camera and settings used by this worker process - see `_initialise_worker`
+_worker = {}
+
+
+def exif_settings(filename):
+    """
+    Read the ISO speed and exposure time of an image from its EXIF data.
+    """
+    exif = io.load_exif_fast(filename)
+    iso_value = exif["EXIF ISOSpeedRatings"]
+    if isinstance(iso_value, list):  # Some cameras give multiple values
+        iso_value = iso_value[0]
+    exposure_time = exif["EXIF ExposureTime"]
+    return int(iso_value), float(exposure_time)
+
+
+def _initialise_worker(root, steps, output, use_plan):
+    """
+    Load the Camera for `root` and its calibration data in a worker process.
+    """
+    camera = io.load_camera(root)
+    camera.load_all_calibrations()
+    _worker["camera"] = camera
+    _worker["steps"] = steps
+    _worker["output"] = output
+    _worker["plan"] = camera.calibration_plan(steps=steps) if use_plan else None
+
+
+def calibrate_file(filename, save_to):
+    """
+    Calibrate the RAW image `filename` using the Camera loaded in this worker
+    process, and save the result to `save_to`. Returns the time spent in each
+    stage (see `stages`), in seconds.
+    """
+    camera = _worker["camera"]
+    timings = {}
+
+    start = perf_counter()
+    iso_value, exposure_time = exif_settings(filename)
+    timings["exif"] = perf_counter() - start
+
+    start = perf_counter()
+    data = io.load_raw_image(filename)
+    timings["load"] = perf_counter() - start
+
+    start = perf_counter()
+    if _worker["plan"] is not None:
+        data = _worker["plan"].apply(data, iso_value, exposure_time)
+    else:
+        data = camera.calibrate(data, iso_value, exposure_time, steps=_worker["steps"])
+    timings["calibrate"] = perf_counter() - start
+
+    start = perf_counter()
+    data = camera.demosaick(data)
+    timings["demosaick"] = perf_counter() - start
+
+    start = perf_counter()
+    if _worker["output"] == "XYZ":
+        data = camera.convert_to_XYZ(data, axis=0)
+    timings["convert"] = perf_counter() - start
+
+    start = perf_counter()
+    makedirs(save_to.parent, exist_ok=True)
+    np.save(save_to, data)
+    timings["save"] = perf_counter() - start
+
+    return timings
+
+
+def calibrate_files(files, save_to, root, steps=None, output="RGBG2", workers=4, max_pending=None, use_plan=False):
+    """
+    Calibrate the RAW images `files` of the camera in `root` and save the
+    results to the corresponding filenames in `save_to`, using a pool of
+    `workers` processes.
+
+    `steps` are the calibration steps applied (default: all, see
+    `Camera.calibrate`). `output` is the output format, one of `outputs`. If
+    `use_plan` is True, each worker uses a calibration plan (see
+    `calibration_plan.CalibrationPlan`), which is faster when many images
+    share the same settings.
+
+    At most `max_pending` images (default: twice the number of workers) are
+    in progress at any time. Returns the total time spent in each stage (see
+    `stages`) and the total wall-clock time, in seconds.
+    """
+    assert output in outputs, f"Unknown output format `{output}`; must be one of {outputs}"
+    assert len(files) == len(save_to), f"Different numbers of input files ({len(files)}) and output files ({len(save_to)}) were given"
+    if steps is None:
+        steps = io.load_camera(root).calibration_steps
+    if max_pending is None:
+        max_pending = 2 * workers
+
+    totals = dict.fromkeys(stages, 0.)
+    jobs = iter(zip(files, save_to))
+    pending = set()
+    nr_done = 0
+
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initialise_worker, initargs=(root, steps, output, use_plan)) as executor:
+        while True:
+            # Keep up to `max_pending` images in progress
+            for filename, save_to_file in jobs:
+                pending.add(executor.submit(calibrate_file, filename, save_to_file))
+                if len(pending) >= max_pending:
+                    break
+
+            if not pending:
+                break
+
+            # Wait for at least one image to finish, and add its timings
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for stage, time in future.result().items():
+                    totals[stage] += time
+                nr_done += 1
+                if nr_done % 10 == 0 or nr_done == len(files):
+                    elapsed = perf_counter() - start
+                    print(f"Calibrated {nr_done}/{len(files)} images ({nr_done/elapsed:.1f} images/s)")
+
+    elapsed = perf_counter() - start
+    return totals, elapsed
@@ -4,7 +4,7 @@ Code relating to bias and read noise, such as loading maps of either.
 
 import numpy as np
 from . import io
-from .general import return_with_filename
+from .general import return_with_filename, calculation_dtype
 
 
 def load_bias_map(root, return_filename=False):
@@ -41,11 +41,15 @@ def load_readnoise_map(root, return_filename=False):
     return return_with_filename(readnoise_map, filename, return_filename)
 
 
-def correct_bias_from_map(bias_map, data):
+def correct_bias_from_map(bias_map, data, out=None):
     """
     Apply a bias correction from a bias map `bias_map` to any number of
     elements in `data`
+
+    The result is calculated in the calibration data type (see
+    `general.set_calibration_dtype`). If an array `out` is given, the result is
+    written to it instead; this may be `data` itself to correct it in place.
     """
-    data_corrected = data - bias_map
+    data_corrected = np.subtract(data, bias_map, out=out, dtype=calculation_dtype(out))
 
     return data_corrected
@@ -0,0 +1,126 @@
+"""
+Code relating to calibration bundles, which store all calibration data for a
+camera (bias map, read noise map, dark current map, ISO lookup table, gain
+map, flat-field correction map, spectral response, etc.) in a single file.
+
+The arrays in a bundle are stored uncompressed and aligned, so they can be
+memory-mapped instead of parsed and re-allocated every time a Camera is
+loaded. Processes that load the same bundle then share its pages in memory.
+
+A bundle also records the modification times of the files in the calibration
+folder it was made from, so outdated bundles can be recognised and ignored.
+
+File layout:
+    * 16-byte magic string
+    * 8-byte (little-endian) length of the header
+    * JSON header describing the metadata and arrays
+    * the arrays, each starting at a multiple of `_alignment` bytes
+"""
+
+import numpy as np
+import json
+import os
+from pathlib import Path
+from .general import round_up
+
+# File properties
+suffix = ".bundle"
+default_filename = f"calibration{suffix}"
+_magic = b"SPECTACLE_BUNDLE"
+_alignment = 4096
+_header_length_bytes = 8
+
+
+def calibration_folder_state(folder, exclude_suffix=suffix):
+    """
+    List the files in a calibration `folder` and their modification times,
+    excluding calibration bundles themselves and hidden (temporary) files.
+    """
+    folder = Path(folder)
+    state = {file.name: file.stat().st_mtime_ns for file in sorted(folder.iterdir()) if file.is_file() and file.suffix != exclude_suffix and not file.name.startswith(".")}
+    return state
+
+
+def write_bundle(path, arrays, metadata={}):
+    """
+    Write a calibration bundle to `path`. `arrays` is a dictionary of array
+    names and arrays; `metadata` is a dictionary of JSON-compatible values
+    stored in the header, such as the camera settings.
+    """
+    path = Path(path)
+    arrays = {name: np.ascontiguousarray(data) for name, data in arrays.items()}
+
+    # Describe each array, leaving the offsets to be filled in
+    header = {"metadata": metadata, "arrays": {name: {"dtype": data.dtype.str, "shape": data.shape, "offset": 0} for name, data in arrays.items()}}
+
+    # Reserve enough space for the header, then place the arrays after it
+    header_length_estimate = len(json.dumps(header)) + 32 * len(arrays)
+    offset = round_up(len(_magic) + _header_length_bytes + header_length_estimate, _alignment)
+    for name, data in arrays.items():
+        header["arrays"][name]["offset"] = offset
+        offset = round_up(offset + data.nbytes, _alignment)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    assert len(_magic) + _header_length_bytes + len(header_bytes) <= round_up(len(_magic) + _header_length_bytes + header_length_estimate, _alignment), "Calibration bundle header does not fit in the reserved space"
+
+    # Write to a temporary file first, so a bundle that is being read is never incomplete
+    temporary = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "wb") as file:
+        file.write(_magic)
+        file.write(len(header_bytes).to_bytes(_header_length_bytes, "little"))
+        file.write(header_bytes)
+        for name, data in arrays.items():
+            file.seek(header["arrays"][name]["offset"])
+            file.write(data.tobytes())
+        file.truncate(offset)
+    os.replace(temporary, path)
+
+
+def _read_header(path):
+    """
+    Read the JSON header from a calibration bundle at `path`.
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(_magic))
+        if magic != _magic:
+            raise ValueError(f"`{path}` is not a calibration bundle.")
+        header_length = int.from_bytes(file.read(_header_length_bytes), "little")
+        header = json.loads(file.read(header_length).decode("utf-8"))
+    return header
+
+
+def load_bundle(path, mmap_mode="r"):
+    """
+    Load a calibration bundle from `path`. Returns the metadata (dictionary)
+    and the arrays (dictionary of arrays, memory-mapped with `mmap_mode`).
+    Use `mmap_mode=None` to read the arrays into memory instead.
+    """
+    header = _read_header(path)
+
+    arrays = {}
+    for name, array in header["arrays"].items():
+        shape = tuple(array["shape"])
+        if mmap_mode is None:
+            with open(path, "rb") as file:
+                file.seek(array["offset"])
+                arrays[name] = np.fromfile(file, dtype=array["dtype"], count=int(np.prod(shape))).reshape(shape)
+        # Arrays with no elements cannot be memory-mapped
+        elif np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=array["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=array["dtype"], mode=mmap_mode, offset=array["offset"], shape=shape)
+
+    return header["metadata"], arrays
+
+
+def bundle_is_current(path, folder=None):
+    """
+    Check if the calibration bundle at `path` is up to date, i.e. if the files
+    in the calibration `folder` (default: the folder containing the bundle)
+    are the same, with the same modification times, as when it was written.
+    """
+    path = Path(path)
+    if folder is None:
+        folder = path.parent
+    metadata = _read_header(path)["metadata"]
+    return metadata.get("calibration_folder") == calibration_folder_state(folder)
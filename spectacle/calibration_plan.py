@@ -0,0 +1,176 @@
+"""
+Code relating to calibration plans, which apply the calibration of a camera
+for a given ISO speed and exposure time as a single affine transformation.
+
+Bias, dark current, ISO normalisation, gain, and flat-field corrections are
+all per-pixel affine operations, so for a fixed ISO speed and exposure time,
+the calibrated data are `a * data + b` with two maps `a` and `b`. These maps
+are calculated once per setting and kept in memory, so calibrating an image
+costs a single multiplication and addition. When the maps use more memory than
+the limit, those for the least recently used settings are removed.
+"""
+
+import numpy as np
+from collections import OrderedDict
+from threading import Lock
+
+# Empty slice that just selects all data - used as default argument
+all_data = np.s_[:]
+
+
+class CalibrationPlan(object):
+    """
+    Object that represents a calibration plan for a Camera, providing
+    functions for calculating the affine calibration maps for a setting and
+    applying them to data.
+    """
+    def __init__(self, camera, steps=None, dtype=np.float32, max_memory=1e9):
+        """
+        Create a calibration plan for `camera`, applying the calibration
+        `steps` (default: all; see `Camera.calibration_steps`). The maps are
+        stored with data type `dtype`, with a memory limit of `max_memory`
+        bytes in total.
+        """
+        self.camera = camera
+        self.steps = camera._check_calibration_steps(camera.calibration_steps if steps is None else steps)
+        self.dtype = np.dtype(dtype)
+        self.max_memory = max_memory
+        self._maps = OrderedDict()  # (ISO speed, exposure time) -> (a, b), least recently used first
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        """
+        Text representation of the CalibrationPlan object
+        """
+        return f"Calibration plan for {self.camera.name} (steps: {self.steps}; {len(self._maps)} settings, {self.memory()/1e6:.1f} MB; hits: {self.hits}, misses: {self.misses})"
+
+    def _key(self, iso_value, exposure_time):
+        """
+        Generate a cache key from an ISO speed and exposure time, ignoring
+        whichever is not used by the calibration steps.
+        """
+        iso_value = int(iso_value) if "iso" in self.steps else None
+        exposure_time = float(exposure_time) if "dark_current" in self.steps else None
+        return (iso_value, exposure_time)
+
+    def memory(self):
+        """
+        Calculate the memory used by all stored maps, in bytes.
+        """
+        return sum(a.nbytes + b.nbytes for a, b in self._maps.values())
+
+    def statistics(self):
+        """
+        Get statistics on the use of the stored maps, as a dictionary.
+        """
+        return {"settings": len(self._maps), "memory": self.memory(), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def clear(self):
+        """
+        Remove all stored maps, for example after the camera's calibration
+        data have changed.
+        """
+        with self._lock:
+            self._maps.clear()
+
+    def _calculate_maps(self, iso_value, exposure_time):
+        """
+        Calculate the affine calibration maps `a` and `b` for a given ISO speed
+        and exposure time, such that the calibrated data are `a * data + b`.
+        """
+        maps = self.camera._load_calibration_maps(self.steps)
+
+        # Offset that is subtracted from the data, and factor the result is multiplied with
+        offset = np.zeros(self.camera.image_shape)
+        factor = np.ones(self.camera.image_shape)
+        if "bias" in self.steps:
+            offset += maps["bias"]
+        if "dark_current" in self.steps:
+            offset += exposure_time * maps["dark_current"]
+        if "iso" in self.steps:
+            factor /= self.camera.iso_lookup_table[1, iso_value]
+        if "gain" in self.steps:
+            factor /= maps["gain"]
+        if "flatfield" in self.steps:
+            factor *= maps["flatfield"]
+
+        # (data - offset) * factor = factor * data - offset * factor
+        a = factor.astype(self.dtype)
+        b = (-offset * factor).astype(self.dtype)
+        return a, b
+
+    def maps(self, iso_value=None, exposure_time=None):
+        """
+        Get the affine calibration maps `a` and `b` for a given ISO speed and
+        exposure time, calculating them if they are not stored yet.
+        """
+        key = self._key(iso_value, exposure_time)
+        with self._lock:
+            if key in self._maps:
+                self._maps.move_to_end(key)
+                self.hits += 1
+                return self._maps[key]
+
+        # Calculate the maps outside the lock, so other settings can be used in the meantime
+        a, b = self._calculate_maps(*key)
+
+        with self._lock:
+            self.misses += 1
+            self._maps[key] = (a, b)
+            self._maps.move_to_end(key)
+            self._evict(keep=key)
+
+        return a, b
+
+    def _evict(self, keep=None):
+        """
+        Remove the maps for the least recently used settings until the plan is
+        within its memory limit. The maps for the setting `keep` are never
+        removed.
+        """
+        total_memory = self.memory()
+        for key in list(self._maps):
+            if total_memory <= self.max_memory:
+                break
+            if key == keep:
+                continue
+            a, b = self._maps.pop(key)
+            total_memory -= a.nbytes + b.nbytes
+            self.evictions += 1
+
+    def apply(self, data, iso_values=None, exposure_time=None, selection=all_data, out=None):
+        """
+        Calibrate `data`, taken at the given ISO speed(s) and exposure time(s),
+        using the stored affine maps for each setting. This gives the same
+        result as `Camera.calibrate`, within the precision of the plan's data
+        type.
+
+        `data` can be a single image or an array of images, in which case
+        `iso_values` and `exposure_time` can be iterables with one value per
+        image. `selection` applies to the calibration maps, as in the Camera
+        methods. The result is written to an existing array `out` if given,
+        which may be `data` itself.
+        """
+        # Treat a single image as a series of one image
+        data = np.asanyarray(data)
+        images = data.reshape((-1, *data.shape[-2:]))
+        if out is None:
+            out = np.empty(data.shape, dtype=self.dtype)
+        assert out.shape == data.shape, f"The data ({data.shape}) and output array ({out.shape}) have different shapes"
+        images_out = out.view()
+        images_out.shape = images.shape  # Raises an error if `out` cannot be reshaped without copying
+
+        # One ISO speed and exposure time per image
+        iso_values = np.broadcast_to(np.asarray(iso_values, dtype=object), (len(images),))
+        exposure_times = np.broadcast_to(np.asarray(exposure_time, dtype=object), (len(images),))
+
+        # Calibrate each image with the maps for its setting
+        for image, image_out, iso_value, exposure_time in zip(images, images_out, iso_values, exposure_times):
+            a, b = self.maps(iso_value, exposure_time)
+            np.multiply(image, a[selection], out=image_out)
+            image_out += b[selection]
+
+        return out
@@ -10,18 +10,54 @@ from collections import namedtuple
 from pathlib import Path
 from os import makedirs
 
-from . import raw, analyse, bias_readnoise, dark, iso, gain, flat, spectral
+from . import raw, analyse, bias_readnoise, dark, iso, gain, flat, spectral, bundle, general
 from .general import return_with_filename, find_matching_file
 
 
 # Empty slice that just selects all data - used as default argument
 all_data = np.s_[:]
 
+# Camera cache, disabled by default - see `enable_camera_cache`
+camera_cache = None
+
+
+def enable_camera_cache(**kwargs):
+    """
+    Enable the Camera cache (see `camera_cache.CameraCache`) for
+    `load_camera` and `find_root_folder`. Cameras loaded from the same root
+    folder are then the same object, re-used until their files change.
+    Any additional **kwargs (e.g. `max_memory`) are passed to `CameraCache`.
+    """
+    global camera_cache
+    from .camera_cache import CameraCache
+    camera_cache = CameraCache(**kwargs)
+    return camera_cache
+
+
+def disable_camera_cache():
+    """
+    Disable the Camera cache and remove all cached Camera objects.
+    """
+    global camera_cache
+    camera_cache = None
+
 
 def find_root_folder(input_path):
     """
     For a given `input_path`, find the root folder, containing the standard
     sub-folders (calibration, analysis, stacks, etc.)
+
+    If the Camera cache is enabled, earlier searches are re-used.
+    """
+    if camera_cache is not None:
+        return camera_cache.find_root_folder(input_path)
+    return _find_root_folder(input_path)
+
+
+def _find_root_folder(input_path):
+    """
+    Find the root folder for a given `input_path` by searching its parents
+    for a camera information file, without using the Camera cache.
     """
     input_path = Path(input_path)
 
@@ -69,6 +105,31 @@ def makedirs_without_file(path):
     makedirs(path_for_makedirs, exist_ok=True)
 
 
+def _to_calibration_dtype(data):
+    """
+    Convert a calibration map `data` to the calibration data type (see
+    `general.set_calibration_dtype`), without copying it if it already has
+    that type. None (no calibration data available) is returned as is.
+    """
+    if data is None:
+        return None
+    return np.asanyarray(data).astype(general.calibration_dtype, copy=False)
+
+
+def _selection_key(selection, shape):
+    """
+    Describe a `selection` of an array with a given `shape` by value, as a
+    tuple of (start, stop, step) per axis, so equivalent selections (e.g. two
+    separate `np.s_[:]` objects, or `np.s_[0:None]`) have the same key.
+    Returns None for selections that are not made of slices (e.g. index arrays).
+    """
+    items = selection if isinstance(selection, tuple) else (selection,)
+    if not all(isinstance(item, slice) or item is Ellipsis for item in items):
+        return None
+    selection = general.expand_selection(items, len(shape))
+    return tuple(item.indices(size) for item, size in zip(selection, shape))
+
+
 def _convert_exposure_time(exposure):
     """
     Convert an exposure time, in various formats, into a floating-point number.
@@ -115,6 +176,11 @@ class Camera(object):
     _Settings = namedtuple("Settings", ["ISO_min", "ISO_max", "exposure_min", "exposure_max"])
 
     calibration_data_all = ["settings", "bias_map", "readnoise", "dark_current", "iso_lookup_table", "gain_map", "flatfield_map", "spectral_response", "spectral_bands", "XYZ_matrix"]
+    calibration_arrays = calibration_data_all[1:]
+    calibration_maps = ["bias_map", "readnoise", "dark_current", "gain_map", "flatfield_map"]  # Stored in the calibration data type
+
+    # Steps in `calibrate`, in the order they are applied
+    calibration_steps = ["bias", "dark_current", "iso", "gain", "flatfield"]
 
     def __init__(self, name, manufacturer, name_internal, image_shape, raw_extension, bias, bayer_pattern, bit_depth, colour_description="RGBG", root=None):
         """
@@ -137,7 +203,7 @@ class Camera(object):
         self.root = root
 
         # Generate/calculate commonly used values/properties
-        self.bayer_map = self._generate_bayer_map()
+        self.bayer = raw.BayerPattern(self.bayer_pattern, self.image_shape)
         self.saturation = 2**self.bit_depth - 1
         self.bands = self.colour_description
 
@@ -181,16 +247,25 @@ class Camera(object):
         dictionary = {prop: getattr(self, prop) for prop in self.property_list}
         return dictionary
 
-    def _generate_bayer_map(self):
+    @property
+    def bayer_map(self):
+        """
+        Bayer map, with the Bayer channel (RGBG2) for each pixel. This is
+        generated from the Bayer pattern (`self.bayer`) when first used, and is
+        a read-only array of data type uint8. Use `np.array(camera.bayer_map)`
+        for a writable copy, or assign a new Bayer map to change the pattern.
+        """
+        return self.bayer.map
+
+    @bayer_map.setter
+    def bayer_map(self, bayer_map):
         """
-        Generate a Bayer map, with the Bayer channel (RGBG2) for each pixel.
+        Change the Bayer pattern to the one in a full Bayer map `bayer_map`,
+        which must repeat a single 2x2 pattern.
         """
-        bayer_map = np.zeros(self.image_shape, dtype=int)
-        bayer_map[0::2, 0::2] = self.bayer_pattern[0][0]
-        bayer_map[0::2, 1::2] = self.bayer_pattern[0][1]
-        bayer_map[1::2, 0::2] = self.bayer_pattern[1][0]
-        bayer_map[1::2, 1::2] = self.bayer_pattern[1][1]
-        return bayer_map
+        bayer = raw.BayerPattern.from_map(bayer_map)
+        assert np.array_equal(bayer.map, bayer_map), "The Bayer map does not repeat a single 2x2 pattern"
+        self.bayer = bayer
 
     def central_slice(self, width_x, width_y):
         """
@@ -220,10 +295,10 @@ class Camera(object):
         """
         Generate a Bayer-aware map of bias values from the camera information.
         """
-        bayer_map = self._generate_bayer_map()
-        for j, bias_value in enumerate(self.bias):
-            bayer_map[bayer_map == j] = bias_value
-        return bayer_map
+        bias_map = np.empty(self.image_shape, dtype=np.asarray(self.bias).dtype)
+        for bias_value, channel in zip(self.bias, self.bayer.channel_slices()):
+            bias_map[channel] = bias_value
+        return bias_map
 
     def _load_bias_map(self):
         """
@@ -244,7 +319,7 @@ class Camera(object):
 
         # Whatever bias map was used, save it to this object so it need not be re-loaded in the future
         finally:
-            self.bias_map = bias_map
+            self.bias_map = _to_calibration_dtype(bias_map)
 
     def _load_readnoise_map(self):
         """
@@ -260,7 +335,7 @@ class Camera(object):
             print(f"Could not find a readnoise map in the folder `{self.root}`")
 
         # The read-noise map is saved to this object
-        self.readnoise = readnoise
+        self.readnoise = _to_calibration_dtype(readnoise)
 
     def _load_dark_current_map(self):
         """
@@ -276,7 +351,7 @@ class Camera(object):
             print(f"Could not find a dark current map in the folder `{self.root}` - using all 0 instead")
 
         # Whatever bias map was used, save it to this object so it need not be re-loaded in the future
-        self.dark_current = dark_current
+        self.dark_current = _to_calibration_dtype(dark_current)
 
     def _generate_ISO_range(self):
         """
@@ -322,7 +397,7 @@ class Camera(object):
 
         # If a gain map was found, save it to this object so it need not be looked up again
         # If no gain map was found, save the None object to warn the user
-        self.gain_map = gain_map
+        self.gain_map = _to_calibration_dtype(gain_map)
 
     def _load_flatfield_correction(self):
         """
@@ -330,7 +405,7 @@ class Camera(object):
         """
         # Try to use a flatfield model from file
         try:
-            correction_map = flat.load_flatfield_correction(self.root, shape=self.image_shape)
+            correction_map = flat.load_flatfield_correction(self.root, shape=self.image_shape, dtype=general.calibration_dtype)
 
         # If a flatfield map cannot be found, do not use any, and warn the user
         except (FileNotFoundError, OSError, TypeError):
@@ -339,7 +414,48 @@ class Camera(object):
 
         # If a flatfield map was found, save it to this object so it need not be looked up again
         # If no flatfield map was found, save the None object to warn the user
-        self.flatfield_map = correction_map
+        self.flatfield_map = _to_calibration_dtype(correction_map)
+
+    def _flatfield_map(self, selection=all_data):
+        """
+        Get the flatfield correction map for the given `selection`. If the full
+        map has not been loaded yet and only part of it is selected, only that
+        part is calculated from the flatfield model. The most recently
+        calculated part is kept, so selecting it again does not calculate it
+        again.
+        """
+        # Compare the selection by value, to recognise selections of the full map
+        key = _selection_key(selection, self.image_shape)
+        full_selection = (key == _selection_key(all_data, self.image_shape))
+
+        # Calculate only the selected part, if a flatfield model is available
+        if not hasattr(self, "flatfield_map") and not full_selection:
+            if not hasattr(self, "flatfield_parameters"):
+                try:
+                    self.flatfield_parameters = flat.load_flatfield_parameters(self.root)
+                except (FileNotFoundError, OSError, TypeError):
+                    self.flatfield_parameters = None
+            if self.flatfield_parameters is not None:
+                # Re-use the most recently calculated part if it is the same
+                key = None if key is None else (key, general.calibration_dtype)
+                key_partial, flatfield_map_partial = getattr(self, "_flatfield_map_partial", (None, None))
+                if key is not None and key == key_partial:
+                    return flatfield_map_partial
+
+                flatfield_map_partial = flat.apply_vignette_radial(self.image_shape, self.flatfield_parameters, selection=selection, dtype=general.calibration_dtype)
+                if key is not None:
+                    flatfield_map_partial.flags.writeable = False
+                    self._flatfield_map_partial = (key, flatfield_map_partial)
+                return flatfield_map_partial
+
+        # Otherwise, use the full flatfield map
+        if not hasattr(self, "flatfield_map"):
+            self._load_flatfield_correction()
+
+        # Assert that a flatfield map was loaded
+        assert self.flatfield_map is not None, "Flatfield map unavailable"
+
+        return self.flatfield_map[selection]
 
     def _load_spectral_response(self):
         """
@@ -392,13 +508,69 @@ class Camera(object):
         # Else, save the None object to warn the user
         self.XYZ_matrix = XYZ_matrix
 
-    def load_all_calibrations(self):
+    def load_all_calibrations(self, use_bundle=True):
         """
         Load all available calibration data for this camera.
+
+        If `use_bundle` is True and the calibration folder contains an up-to-
+        date calibration bundle (see `write_calibration_bundle`), the data are
+        memory-mapped from the bundle instead of loaded from separate files.
         """
+        if use_bundle and self._load_calibration_bundle():
+            return
+
         for func in [self.load_settings, self._load_bias_map, self._load_dark_current_map, self._load_flatfield_correction, self._load_gain_map, self._load_iso_normalisation, self._load_readnoise_map, self._load_spectral_response, self.load_spectral_bands, self._load_XYZ_matrix]:
             func()
 
+    def write_calibration_bundle(self):
+        """
+        Load all available calibration data for this camera from separate
+        files, and write them to a single calibration bundle in the
+        calibration folder. Returns the filename of the bundle.
+
+        The bundle is only used while the other files in the calibration
+        folder do not change; after re-calibrating, write a new bundle.
+        """
+        self.load_all_calibrations(use_bundle=False)
+
+        # Collect all calibration data that are available
+        arrays = {name: getattr(self, name) for name in self.calibration_arrays if getattr(self, name, None) is not None}
+        settings = self.settings._asdict() if hasattr(self, "settings") else None
+        metadata = {"camera": self._as_dict(), "settings": settings, "bias_type": self.bias_type, "calibration_folder": bundle.calibration_folder_state(self.root/"calibration")}
+
+        filename = self.filename_calibration(bundle.default_filename)
+        bundle.write_bundle(filename, arrays, metadata)
+        return filename
+
+    def _load_calibration_bundle(self):
+        """
+        Load all calibration data from the calibration bundle in the root
+        folder, if it exists and is up to date. Returns True if the data were
+        loaded, False if not.
+        """
+        # Find the bundle and check that it is up to date
+        try:
+            filename = find_matching_file(self.root/"calibration", bundle.default_filename)
+        except (FileNotFoundError, OSError, TypeError):
+            return False
+        if not bundle.bundle_is_current(filename):
+            print(f"Calibration bundle `{filename}` is out of date and will not be used.")
+            return False
+
+        metadata, arrays = bundle.load_bundle(filename)
+
+        # Add the calibration data to this object - any data not in the bundle were not available
+        if metadata["settings"] is not None:
+            self.settings = self._Settings(**metadata["settings"])
+        self.bias_type = metadata["bias_type"]
+        for name in self.calibration_arrays:
+            data = arrays.get(name)
+            if name in self.calibration_maps:
+                data = _to_calibration_dtype(data)
+            setattr(self, name, data)
+
+        return True
+
     def check_calibration_data(self):
         """
         Check what calibration data have been loaded so far.
@@ -407,10 +579,14 @@ class Camera(object):
         data_available = [data_type for data_type in data_available if getattr(self, data_type) is not None]
         return data_available
 
-    def correct_bias(self, data, selection=all_data):
+    def correct_bias(self, data, selection=all_data, out=None):
         """
         Correct data for bias using this sensor's data.
         Bias data are loaded from the root folder or from the camera information.
+
+        The result is calculated in the calibration data type (see
+        `general.set_calibration_dtype`), or written to an existing array `out`
+        if given, which may be `data` itself.
         """
         # If a bias map has not been loaded yet, do so
         if not hasattr(self, "bias_map"):
@@ -420,14 +596,18 @@ class Camera(object):
         bias_map = self.bias_map[selection]
 
         # Apply the bias correction
-        data_corrected = bias_readnoise.correct_bias_from_map(bias_map, data)
+        data_corrected = bias_readnoise.correct_bias_from_map(bias_map, data, out=out)
         return data_corrected
 
-    def correct_dark_current(self, exposure_time, data, selection=all_data):
+    def correct_dark_current(self, exposure_time, data, selection=all_data, out=None):
         """
         Calibrate data for dark current using this sensor's data.
         Dark current data are loaded from the root folder or estimated 0 in all pixels,
         if no data were available.
+
+        The result is calculated in the calibration data type (see
+        `general.set_calibration_dtype`), or written to an existing array `out`
+        if given, which may be `data` itself.
         """
         # If a dark current map has not been loaded yet, do so
         if not hasattr(self, "dark_current"):
@@ -437,26 +617,34 @@ class Camera(object):
         dark_current = self.dark_current[selection]
 
         # Apply the dark current correction
-        data_corrected = dark.correct_dark_current_from_map(dark_current, exposure_time, data)
+        data_corrected = dark.correct_dark_current_from_map(dark_current, exposure_time, data, out=out)
         return data_corrected
 
-    def normalise_iso(self, iso_values, data):
+    def normalise_iso(self, iso_values, data, out=None):
         """
         Normalise data for their ISO speed using this sensor's lookup table.
         The ISO lookup table is loaded from the root folder.
+
+        The result is calculated in the calibration data type (see
+        `general.set_calibration_dtype`), or written to an existing array `out`
+        if given, which may be `data` itself.
         """
         # If a lookup table has not been loaded yet, do so
         if not hasattr(self, "iso_lookup_table"):
             self._load_iso_normalisation()
 
         # Apply the ISO normalisation
-        data_corrected = iso.normalise_iso(self.iso_lookup_table, iso_values, data)
+        data_corrected = iso.normalise_iso(self.iso_lookup_table, iso_values, data, out=out)
         return data_corrected
 
-    def convert_to_photoelectrons(self, data, selection=all_data):
+    def convert_to_photoelectrons(self, data, selection=all_data, out=None):
         """
         Convert data from ADU to photoelectrons using this sensor's gain data.
         The gain data are loaded from the root folder.
+
+        The result is calculated in the calibration data type (see
+        `general.set_calibration_dtype`), or written to an existing array `out`
+        if given, which may be `data` itself.
         """
         # If a gain map has not been loaded yet, do so
         if not hasattr(self, "gain_map"):
@@ -469,28 +657,145 @@ class Camera(object):
         gain_map = self.gain_map[selection]
 
         # If a gain map was available, apply it
-        data_converted = gain.convert_to_photoelectrons_from_map(gain_map, data)
+        data_converted = gain.convert_to_photoelectrons_from_map(gain_map, data, out=out)
         return data_converted
 
-    def correct_flatfield(self, data, selection=all_data, **kwargs):
+    def correct_flatfield(self, data, selection=all_data, out=None, **kwargs):
         """
         Correct data for flatfield using this sensor's flatfield data.
         The flatfield data are loaded from the root folder.
-        """
-        # If a flatfield map has not been loaded yet, do so
-        if not hasattr(self, "flatfield_map"):
-            self._load_flatfield_correction()
 
-        # Assert that a flatfield map was loaded
-        assert self.flatfield_map is not None, "Flatfield map unavailable"
+        The result is calculated in the calibration data type (see
+        `general.set_calibration_dtype`), or written to an existing array `out`
+        if given, which may be `data` itself.
 
+        If the flatfield map has not been loaded yet, only the part given by
+        `selection` is calculated.
+        """
         # Select the relevant data
-        flatfield_map = self.flatfield_map[selection]
+        flatfield_map = self._flatfield_map(selection)
 
         # If a flatfield map was available, apply it
-        data_corrected = flat.correct_flatfield_from_map(flatfield_map, data, **kwargs)
+        data_corrected = flat.correct_flatfield_from_map(flatfield_map, data, out=out, **kwargs)
         return data_corrected
 
+    def _check_calibration_steps(self, steps):
+        """
+        Check that all calibration `steps` are known, and put them in the
+        order in which they are applied (see `calibration_steps`).
+        """
+        assert set(steps) <= set(self.calibration_steps), f"Unknown calibration steps: {set(steps) - set(self.calibration_steps)}; must be in {self.calibration_steps}"
+        steps = [step for step in self.calibration_steps if step in steps]
+        return steps
+
+    def _load_calibration_maps(self, steps, selection=all_data):
+        """
+        Load the calibration maps needed for the calibration `steps`, if they
+        have not been loaded yet, and return the relevant data for each step.
+        """
+        maps = {}
+        if "bias" in steps:
+            if not hasattr(self, "bias_map"):
+                self._load_bias_map()
+            maps["bias"] = self.bias_map[selection]
+        if "dark_current" in steps:
+            if not hasattr(self, "dark_current"):
+                self._load_dark_current_map()
+            maps["dark_current"] = self.dark_current[selection]
+        if "iso" in steps:
+            if not hasattr(self, "iso_lookup_table"):
+                self._load_iso_normalisation()
+        if "gain" in steps:
+            if not hasattr(self, "gain_map"):
+                self._load_gain_map()
+            assert self.gain_map is not None, "Gain map unavailable"
+            maps["gain"] = self.gain_map[selection]
+        if "flatfield" in steps:
+            maps["flatfield"] = self._flatfield_map(selection)
+        return maps
+
+    def calibration_plan(self, **kwargs):
+        """
+        Create a calibration plan for this camera (see
+        `calibration_plan.CalibrationPlan`), which applies all calibration
+        steps for a given ISO speed and exposure time as a single affine
+        transformation. Any additional **kwargs are passed to `CalibrationPlan`.
+        """
+        from .calibration_plan import CalibrationPlan
+        return CalibrationPlan(self, **kwargs)
+
+    def calibrate(self, data, iso_values=None, exposure_time=None, steps=calibration_steps, selection=all_data, out=None, block_size=2**16):
+        """
+        Apply several calibration steps to `data` in a single pass, giving the
+        same result as calling the separate correction methods in order:
+            "bias": `correct_bias`
+            "dark_current": `correct_dark_current`, requires `exposure_time`
+            "iso": `normalise_iso`, requires `iso_values`
+            "gain": `convert_to_photoelectrons`
+            "flatfield": `correct_flatfield`
+        The `steps` are always applied in this order.
+
+        `data` can be a single image or an array of images, in which case
+        `iso_values` and `exposure_time` can be iterables with one value per
+        image. `selection` applies to the calibration maps, as in the separate
+        methods.
+
+        Each image is calibrated in blocks of about `block_size` pixels, which
+        stay in the CPU cache between steps, and written directly into one
+        output array. The result is calculated in the calibration data type
+        (see `general.set_calibration_dtype`), or written to an existing array
+        `out` if given, which may be `data` itself.
+        """
+        steps = self._check_calibration_steps(steps)
+        if "dark_current" in steps:
+            assert exposure_time is not None, "Dark current correction requires an exposure time"
+        if "iso" in steps:
+            assert iso_values is not None, "ISO normalisation requires ISO speeds"
+
+        maps = self._load_calibration_maps(steps, selection=selection)
+
+        # Treat a single image as a series of one image
+        data = np.asanyarray(data)
+        images = data.reshape((-1, *data.shape[-2:]))
+        nr_images, nr_rows, nr_columns = images.shape
+        if out is None:
+            out = np.empty(data.shape, dtype=general.calibration_dtype)
+        assert out.shape == data.shape, f"The data ({data.shape}) and output array ({out.shape}) have different shapes"
+        images_out = out.view()
+        images_out.shape = images.shape  # Raises an error if `out` cannot be reshaped without copying
+
+        # One exposure time and ISO normalisation factor per image
+        if "dark_current" in steps:
+            exposure_times = np.broadcast_to(exposure_time, (nr_images,))
+        if "iso" in steps:
+            normalisations = np.broadcast_to(self.iso_lookup_table[1, np.asarray(iso_values)], (nr_images,))
+
+        # Loop over the images and over blocks of rows within each image
+        block_rows = max(1, block_size // nr_columns)
+        dark_current_block = np.empty((block_rows, nr_columns), dtype=out.dtype)
+        for j, (image, image_out) in enumerate(zip(images, images_out)):
+            for start in range(0, nr_rows, block_rows):
+                block = np.s_[start:start+block_rows]
+                result = image_out[block]
+
+                # Apply each step to this block in place
+                if "bias" in steps:
+                    np.subtract(image[block], maps["bias"][block], out=result)
+                elif not np.may_share_memory(result, image):
+                    result[...] = image[block]
+                if "dark_current" in steps:
+                    dark_current = dark_current_block[:len(result)]
+                    np.multiply(maps["dark_current"][block], exposure_times[j], out=dark_current)
+                    result -= dark_current
+                if "iso" in steps:
+                    result /= normalisations[j]
+                if "gain" in steps:
+                    result /= maps["gain"][block]
+                if "flatfield" in steps:
+                    result *= maps["flatfield"][block]
+
+        return out
+
     def correct_spectral_response(self, data_wavelengths, data, **kwargs):
         """
         Correct data for the sensor's spectral response functions.
@@ -585,12 +890,14 @@ class Camera(object):
     def demosaick(self, data, selection=all_data, **kwargs):
         """
         Demosaick data using this camera's Bayer pattern.
+        Any additional **kwargs (e.g. `copy=False` to get views of the data)
+        are passed to `raw.demosaick`.
         """
-        # Select the relevant data
-        bayer_map = self.bayer_map[selection]
+        # Select the relevant part of the Bayer pattern
+        bayer = self.bayer[selection]
 
         # Demosaick the data
-        RGBG_data = raw.demosaick(bayer_map, data, color_desc=self.bands, **kwargs)
+        RGBG_data = raw.demosaick(bayer, data, color_desc=self.bands, **kwargs)
         return RGBG_data
 
     def plot_spectral_response(self, **kwargs):
@@ -608,14 +915,14 @@ class Camera(object):
         Plot Gaussian maps using analyse.plot_gauss_maps.
         Uses this camera's Bayer pattern.
         """
-        analyse.plot_gauss_maps(data, self.bayer_map, **kwargs)
+        analyse.plot_gauss_maps(data, self.bayer, **kwargs)
 
     def plot_histogram_RGB(self, data, **kwargs):
         """
         Plot an RGB histogram maps using analyse.plot_gauss_maps.
         Uses this camera's Bayer pattern.
         """
-        analyse.plot_histogram_RGB(data, self.bayer_map, **kwargs)
+        analyse.plot_histogram_RGB(data, self.bayer, **kwargs)
 
     def filename_analysis(self, suffix, makefolders=False):
         """
@@ -671,7 +978,16 @@ class Camera(object):
         return cls(**properties, root=root)
 
 
-dummy_camera = Camera(name="Dummy", manufacturer="SPECTACLE", name_internal="dummy-123", image_shape=[1080, 1920], raw_extension=".dng", bias=[0,0,0,0], bayer_pattern=[[0,1],[2,3]], bit_depth=11, colour_description="RGBG", root=Path(__file__).parent)
+def __getattr__(name):
+    """
+    Provide `dummy_camera` as a module attribute, creating it when first used
+    rather than when the module is imported.
+    """
+    if name == "dummy_camera":
+        global dummy_camera
+        dummy_camera = Camera(name="Dummy", manufacturer="SPECTACLE", name_internal="dummy-123", image_shape=[1080, 1920], raw_extension=".dng", bias=[0,0,0,0], bayer_pattern=[[0,1],[2,3]], bit_depth=11, colour_description="RGBG", root=Path(__file__).parent)
+        return dummy_camera
+    raise AttributeError(f"module `{__name__}` has no attribute `{name}`")
 
 
 def load_json(path):
@@ -704,6 +1020,9 @@ def load_camera(root, return_filename=False):
     this is handled.
 
     If `return_filename` is True, also return the exact filename used.
+
+    If the Camera cache is enabled (see `enable_camera_cache`), a cached
+    Camera object is returned if its files have not changed.
     """
     root = Path(root)
 
@@ -715,6 +1034,9 @@ def load_camera(root, return_filename=False):
         root = find_root_folder(root)
         print(f"load_metadata was given a file (`{root_original}`) instead of a folder. Found a correct root folder to use instead: `{root}`")
 
-    filename = find_matching_file(root, "data.json")
-    metadata = Camera.read_from_file(filename)
+    if camera_cache is not None:
+        metadata, filename = camera_cache.load_camera(root)
+    else:
+        filename = find_matching_file(root, "data.json")
+        metadata = Camera.read_from_file(filename)
     return return_with_filename(metadata, filename, return_filename)
@@ -0,0 +1,180 @@
+"""
+Code relating to the Camera cache, which keeps Camera objects (and the
+calibration data they have loaded) in memory, so repeated calls to
+`load_camera` and `find_root_folder` for the same camera do not search the
+file system and re-load calibration data every time.
+
+Cached Camera objects are re-used as long as the camera information file and
+the files in the calibration folder do not change (based on their
+modification times). When the cached Camera objects use more memory than the
+limit, the least recently used ones are removed.
+
+The cache is opt-in, see `camera.enable_camera_cache`.
+"""
+
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from threading import RLock
+from . import camera, bundle
+
+
+def _camera_state(root, metadata_filename):
+    """
+    Describe the state of the files a Camera is loaded from: the modification
+    times of the camera information file `metadata_filename` and of all files
+    in the calibration folder of `root`.
+    """
+    calibration_folder = root/"calibration"
+    calibration_state = bundle.calibration_folder_state(calibration_folder) if calibration_folder.is_dir() else {}
+    state = (metadata_filename.stat().st_mtime_ns, tuple(calibration_state.items()))
+    return state
+
+
+def camera_memory(camera_object):
+    """
+    Calculate the memory used by the arrays stored in a Camera object, in
+    bytes. Memory-mapped arrays (e.g. from a calibration bundle) are not
+    counted, since they are backed by a file rather than held in memory.
+    """
+    arrays = [value for value in vars(camera_object).values() if isinstance(value, np.ndarray) and not isinstance(value, np.memmap)]
+    return sum(array.nbytes for array in arrays)
+
+
+class CameraCache(object):
+    """
+    Object that represents a cache of Camera objects, providing functions for
+    loading Cameras and finding root folders through it.
+    """
+    def __init__(self, max_memory=2e9):
+        """
+        Create an empty Camera cache, with a memory limit of `max_memory`
+        bytes for the calibration data held by the cached Camera objects.
+        """
+        self.max_memory = max_memory
+        self._cameras = OrderedDict()  # Resolved root folder -> (state, Camera, metadata filename), least recently used first
+        self._roots = {}  # Resolved input path -> (root folder, metadata filename)
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        """
+        Text representation of the CameraCache object
+        """
+        return f"Camera cache with {len(self)} cameras ({self.memory()/1e6:.1f} MB; limit: {self.max_memory/1e9:.1f} GB; hits: {self.hits}, misses: {self.misses})"
+
+    def __len__(self):
+        """
+        Number of Camera objects in the cache.
+        """
+        return len(self._cameras)
+
+    def memory(self):
+        """
+        Calculate the memory used by all cached Camera objects, in bytes.
+        """
+        with self._lock:
+            return sum(camera_memory(camera_object) for _, camera_object, _ in self._cameras.values())
+
+    def statistics(self):
+        """
+        Get statistics on the use of the cache, as a dictionary.
+        """
+        with self._lock:
+            return {"cameras": len(self), "memory": self.memory(), "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "evictions": self.evictions}
+
+    def find_root_folder(self, input_path):
+        """
+        Find the root folder for a given `input_path` (see
+        `camera.find_root_folder`), re-using the result of earlier searches
+        as long as the camera information file still exists.
+        """
+        path = Path(input_path).resolve()
+        with self._lock:
+            if path in self._roots:
+                root, metadata_filename = self._roots[path]
+                if metadata_filename.is_file():
+                    return root
+
+            root = camera._find_root_folder(path)
+            self._roots[path] = (root, camera.find_matching_file(root, "data.json"))
+            return root
+
+    def load_camera(self, root):
+        """
+        Load the Camera object for the `root` folder (see `camera.load_camera`)
+        from the cache, or from file if it is not in the cache or its files
+        have changed. Returns the Camera object and the camera information
+        filename.
+        """
+        root = Path(root).resolve()
+        with self._lock:
+            if root in self._cameras:
+                state, camera_object, metadata_filename = self._cameras[root]
+
+                # Use the cached Camera if its files have not changed
+                try:
+                    state_now = _camera_state(root, metadata_filename)
+                except FileNotFoundError:
+                    state_now = None
+                if state_now == state:
+                    self._cameras.move_to_end(root)
+                    self.hits += 1
+                    return camera_object, metadata_filename
+
+                # Otherwise, remove it and load the Camera again
+                del self._cameras[root]
+                self.invalidations += 1
+
+            self.misses += 1
+            metadata_filename = camera.find_matching_file(root, "data.json")
+            state = _camera_state(root, metadata_filename)
+            camera_object = camera.Camera.read_from_file(metadata_filename)
+            self._cameras[root] = (state, camera_object, metadata_filename)
+            self._evict(keep=root)
+
+            return camera_object, metadata_filename
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used Camera objects until the cache is within
+        its memory limit. The Camera for the root folder `keep` is never removed.
+        """
+        memory = {root: camera_memory(camera_object) for root, (_, camera_object, _) in self._cameras.items()}
+        total_memory = sum(memory.values())
+        for root in list(self._cameras):
+            if total_memory <= self.max_memory:
+                break
+            if root == keep:
+                continue
+            del self._cameras[root]
+            total_memory -= memory[root]
+            self.evictions += 1
+
+    def trim(self):
+        """
+        Remove the least recently used Camera objects until the cache is within
+        its memory limit. This is also done whenever a Camera is loaded, but
+        cached Camera objects grow as they load more calibration data.
+        """
+        with self._lock:
+            self._evict()
+
+    def invalidate(self, root=None):
+        """
+        Remove the Camera for the `root` folder from the cache, or all Cameras
+        and root folder searches if no `root` is given.
+        """
+        with self._lock:
+            if root is None:
+                self.invalidations += len(self._cameras)
+                self._cameras.clear()
+                self._roots.clear()
+            else:
+                root = Path(root).resolve()
+                if self._cameras.pop(root, None) is not None:
+                    self.invalidations += 1
+                self._roots = {path: value for path, value in self._roots.items() if value[0] != root}
@@ -0,0 +1,214 @@
+"""
+Code relating to image catalogs, which store the EXIF metadata (ISO speed,
+exposure time, etc.) of every image in a folder tree in a local SQLite
+database. This way, images matching certain settings can be found without
+globbing the folder tree or parsing filenames every time.
+
+The folder tree is scanned once; later scans only read the metadata of files
+that are new or have changed (based on their modification time and size).
+"""
+
+import sqlite3
+import json
+from os import walk, sep
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from . import io
+
+# Default filename for the catalog database, placed in the scanned folder
+default_database_name = "spectacle_catalog.sqlite"
+
+# File extensions that are included in a catalog (case-insensitive)
+image_extensions = (".dng", ".nef", ".cr2", ".arw", ".raw", ".jpg", ".jpeg")
+
+# EXIF tags used for each column in the catalog
+_exif_tags = {"iso": "EXIF ISOSpeedRatings", "exposure_time": "EXIF ExposureTime", "make": "Image Make", "model": "Image Model", "black_level": "Image BlackLevel"}
+
+_columns = ["path", "mtime", "size", "iso", "exposure_time", "make", "model", "black_level"]
+
+# Python types corresponding to the declared types of the EXIF columns
+_column_types = {"iso": int, "exposure_time": float, "make": str, "model": str, "black_level": str}
+
+_create_table = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    iso INTEGER,
+    exposure_time REAL,
+    make TEXT,
+    model TEXT,
+    black_level TEXT
+);
+CREATE INDEX IF NOT EXISTS images_settings ON images (iso, exposure_time);
+"""
+
+
+def exif_properties(filename):
+    """
+    Retrieve the properties used in an image catalog (ISO speed, exposure
+    time, make, model, black level) from the EXIF data of `filename`.
+    Properties that are not available in the EXIF data are None.
+    """
+    exif = io.load_exif_fast(filename)
+
+    properties = {key: exif.get(tag_name) for key, tag_name in _exif_tags.items()}
+
+    # The black level may contain one value per channel
+    if properties["black_level"] is not None:
+        properties["black_level"] = json.dumps(properties["black_level"])
+
+    # Some cameras give multiple ISO speeds; use the first, as in `batch.exif_settings`
+    if isinstance(properties["iso"], list):
+        properties["iso"] = properties["iso"][0] if properties["iso"] else None
+
+    # Convert each property to the declared type of its column, or None if this is not possible
+    for key, column_type in _column_types.items():
+        if properties[key] is None:
+            continue
+        try:
+            properties[key] = column_type(properties[key])
+        except (TypeError, ValueError):
+            properties[key] = None
+
+    return properties
+
+
+def _stat_file(filename):
+    """
+    Get the modification time and size of a file `filename`.
+    """
+    stat = Path(filename).stat()
+    return stat.st_mtime, stat.st_size
+
+
+def _find_image_files(folder):
+    """
+    Walk through `folder` and all its subfolders and find all image files.
+    """
+    for current_folder, subfolders, files in walk(folder):
+        for file in files:
+            if file.lower().endswith(image_extensions):
+                yield Path(current_folder) / file
+
+
+class ImageCatalog(object):
+    """
+    Object that represents an image catalog, providing functions for scanning
+    a folder tree and querying the images in it.
+    """
+    def __init__(self, folder, database=None):
+        """
+        Open (or create) the catalog for the images in `folder`. By default,
+        the catalog database is saved in `folder` itself; a different location
+        can be given with `database`.
+        """
+        self.folder = Path(folder).absolute()
+        self.database = self.folder/default_database_name if database is None else Path(database)
+
+        self.connection = sqlite3.connect(str(self.database))
+        self.connection.executescript(_create_table)
+
+    def __repr__(self):
+        """
+        Text representation of the ImageCatalog object
+        """
+        return f"Image catalog of `{self.folder}` ({len(self)} images; stored in `{self.database}`)"
+
+    def __len__(self):
+        """
+        Number of images in the catalog.
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def close(self):
+        """
+        Close the connection to the catalog database.
+        """
+        self.connection.close()
+
+    def scan(self, workers=8):
+        """
+        Scan the folder tree for images and update the catalog. Only files that
+        are new or whose modification time or size changed are read, using a
+        pool of `workers` threads. Files that no longer exist are removed.
+
+        Returns the number of images that were added or updated, and the number
+        that were removed.
+        """
+        # Files currently in the catalog, and their modification time and size
+        known = {path: (mtime, size) for path, mtime, size in self.connection.execute("SELECT path, mtime, size FROM images")}
+
+        # Files currently on disk, and the ones that need to be (re-)read
+        on_disk = {str(file): _stat_file(file) for file in _find_image_files(self.folder)}
+        to_read = [path for path, stat in on_disk.items() if known.get(path) != stat]
+        to_remove = [path for path in known if path not in on_disk]
+
+        # Read the EXIF data of new or changed files in parallel
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            properties = list(executor.map(exif_properties, to_read))
+
+        # Update the catalog
+        rows = [(path, *on_disk[path], *[props[key] for key in _columns[3:]]) for path, props in zip(to_read, properties)]
+        with self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO images ({', '.join(_columns)}) VALUES ({', '.join('?' * len(_columns))})", rows)
+            self.connection.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in to_remove])
+
+        return len(to_read), len(to_remove)
+
+    def query(self, iso=None, exposure_min=None, exposure_max=None, make=None, model=None, folder=None):
+        """
+        Find all images in the catalog with the given properties, sorted by
+        their path. `iso`, `make`, and `model` must match exactly. Exposure
+        times must lie between `exposure_min` and `exposure_max`, inclusive.
+        If a `folder` is given, only images in that folder (or its subfolders)
+        are included.
+
+        Any property that is None is not used.
+
+        For example, all images at ISO 100 with exposure times between 1/1000
+        and 1/10 seconds:
+            `catalog.query(iso=100, exposure_min=1/1000, exposure_max=1/10)`
+        """
+        conditions, parameters = [], []
+        for condition, parameter in [("iso = ?", iso), ("exposure_time >= ?", exposure_min), ("exposure_time <= ?", exposure_max), ("make = ?", make), ("model = ?", model)]:
+            if parameter is not None:
+                conditions.append(condition)
+                parameters.append(parameter)
+
+        # Restrict the query to a subfolder using a range on the path, so the primary key index is used
+        if folder is not None:
+            folder_prefix = str(Path(folder).absolute()).rstrip(sep) + sep
+            conditions.append("path >= ? AND path < ?")
+            parameters.extend([folder_prefix, folder_prefix[:-1] + chr(ord(sep) + 1)])
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection.execute(f"SELECT path FROM images {where} ORDER BY path", parameters)
+        paths = [Path(path) for path, in rows]
+        return paths
+
+    def properties(self, path):
+        """
+        Retrieve the catalogued properties of a single image at `path`, as a
+        dictionary. Raises a KeyError if the image is not in the catalog.
+        """
+        row = self.connection.execute(f"SELECT {', '.join(_columns)} FROM images WHERE path = ?", (str(Path(path).absolute()),)).fetchone()
+        if row is None:
+            raise KeyError(f"Image `{path}` is not in the catalog `{self.database}`")
+        properties = dict(zip(_columns, row))
+        if properties["black_level"] is not None:
+            properties["black_level"] = json.loads(properties["black_level"])
+        return properties
+
+
+def load_catalog(folder, scan=True, **kwargs):
+    """
+    Open the image catalog for `folder`, and (by default) scan the folder tree
+    for new or changed images first. Any additional **kwargs are passed to
+    `ImageCatalog.scan`.
+    """
+    catalog = ImageCatalog(folder)
+    if scan:
+        nr_updated, nr_removed = catalog.scan(**kwargs)
+        print(f"Updated {nr_updated} and removed {nr_removed} images in the catalog of `{catalog.folder}`")
+    return catalog
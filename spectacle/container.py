@@ -0,0 +1,287 @@
+"""
+Code relating to stack containers, which store a whole calibration series
+(for example the mean and standard deviation stacks at every exposure time)
+in a single file.
+
+Each frame is split into tiles, which are stored contiguously, so a small
+region of interest can be read from any subset of frames without reading the
+full frames. A metadata table (e.g. ISO speed, exposure time, polariser angle)
+is embedded in the file header, so frames can be found without parsing
+filenames.
+
+File layout:
+    * 16-byte magic string
+    * 8-byte (little-endian) length of the header
+    * JSON header describing the metadata table and datasets
+    * the datasets, each starting at a multiple of `_alignment` bytes and
+    stored as an array of shape (frames, tile rows, tile columns, tile height,
+    tile width, ...)
+"""
+
+import numpy as np
+import json
+from pathlib import Path
+from .general import round_up, expand_selection
+
+# File properties
+suffix = ".stack"
+_magic = b"SPECTACLE_STACK\n"
+_alignment = 4096
+_header_length_bytes = 8
+
+# Default datasets and data types
+default_datasets = {"mean": "float32", "stds": "float32"}
+default_tile_shape = (256, 256)
+
+# Empty slice that just selects all data - used as default argument
+all_data = np.s_[:]
+
+
+def is_stack_container(path):
+    """
+    Check if a given `path` is a stack container file.
+    """
+    path = Path(path)
+    if not path.is_file():
+        return False
+    with open(path, "rb") as file:
+        return file.read(len(_magic)) == _magic
+
+
+def _read_header(path):
+    """
+    Read the JSON header from a stack container file at `path`.
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(_magic))
+        if magic != _magic:
+            raise ValueError(f"`{path}` is not a stack container file.")
+        header_length = int.from_bytes(file.read(_header_length_bytes), "little")
+        header = json.loads(file.read(header_length).decode("utf-8"))
+    return header
+
+
+def _selection_to_bounds(item, size):
+    """
+    Find the range of elements (start, stop) on an axis of length `size` that
+    contains all elements selected by `item`, as well as the selection relative
+    to that range.
+    """
+    # Slices with a positive step only need the elements between their ends
+    if isinstance(item, slice):
+        start, stop, step = item.indices(size)
+        if step > 0:
+            stop = max(start, stop)
+            return (start, stop), slice(0, stop-start, step)
+
+    # Anything else (integers, index arrays, negative steps) uses the full axis
+    return (0, size), item
+
+
+class StackContainer(object):
+    """
+    Object that represents a stack container file, providing access to its
+    metadata table and to any region of any subset of its frames.
+    """
+    def __init__(self, path, mode="r"):
+        """
+        Open the stack container at `path`. Use `mode="r+"` to write data to it.
+        """
+        self.path = Path(path)
+        self.mode = mode
+
+        header = _read_header(self.path)
+        self.frame_shape = tuple(header["frame_shape"])
+        self.tile_shape = tuple(header["tile_shape"])
+        self.metadata = {key: np.array(column) for key, column in header["metadata"].items()}
+        self.nr_frames = header["nr_frames"]
+        self.datasets = {name: dataset["dtype"] for name, dataset in header["datasets"].items()}
+
+        # Shape of the frames in each dataset, which may differ from the default (e.g. for JPEG stacks)
+        self.frame_shapes = {name: tuple(dataset.get("frame_shape", self.frame_shape)) for name, dataset in header["datasets"].items()}
+
+        # Number of tiles along each axis
+        self.nr_tiles = self._nr_tiles(self.frame_shape)
+
+        # Memory-map every dataset - this does not read any data yet
+        self._data = {name: np.memmap(self.path, dtype=dataset["dtype"], mode=mode, offset=dataset["offset"], shape=self._tiled_shape(self.frame_shapes[name])) for name, dataset in header["datasets"].items()}
+
+    def __repr__(self):
+        """
+        Text representation of the StackContainer object
+        """
+        return f"Stack container with {self.nr_frames} frames of shape {self.frame_shape} (datasets: {list(self.datasets)}; from `{self.path}`)"
+
+    def __len__(self):
+        """
+        Number of frames in the container.
+        """
+        return self.nr_frames
+
+    def _nr_tiles(self, frame_shape):
+        """
+        Number of tiles along each axis of a frame of shape `frame_shape`.
+        """
+        return tuple(round_up(size, tile) // tile for size, tile in zip(frame_shape, self.tile_shape))
+
+    def _tiled_shape(self, frame_shape):
+        """
+        Shape of a dataset on disk with frames of shape `frame_shape`, per frame
+        split into tiles.
+        """
+        return (self.nr_frames, *self._nr_tiles(frame_shape), *self.tile_shape, *frame_shape[2:])
+
+    @classmethod
+    def create(cls, path, frame_shape, metadata, datasets=default_datasets, tile_shape=default_tile_shape, frame_shapes={}):
+        """
+        Create an empty stack container at `path` and open it for writing.
+
+        `metadata` is a dictionary containing one column (list) per property,
+        for example "label", "iso" and "exposure_time", with one element per
+        frame. `datasets` is a dictionary of dataset names and their data types.
+        Frames of shape `frame_shape` are split into tiles of shape `tile_shape`
+        along their first two axes. Datasets whose frames have a different shape
+        (e.g. JPEG stacks next to RAW stacks) can be given one in `frame_shapes`,
+        a dictionary of dataset names and frame shapes.
+        """
+        path = Path(path)
+        frame_shapes = {name: tuple(int(size) for size in frame_shapes.get(name, frame_shape)) for name in datasets}
+        frame_shape = tuple(int(size) for size in frame_shape)
+        tile_shape = tuple(int(size) for size in tile_shape)
+        for shape in [frame_shape, *frame_shapes.values()]:
+            assert len(shape) >= 2, f"Frames must have at least two axes, not shape {shape}"
+        assert len(tile_shape) == 2, f"Tiles must have two axes, not shape {tile_shape}"
+
+        # Convert the metadata to lists and check their lengths
+        metadata = {key: np.asarray(column).tolist() for key, column in metadata.items()}
+        lengths = {len(column) for column in metadata.values()}
+        assert len(lengths) == 1, f"Metadata columns have different lengths: {lengths}"
+        nr_frames = lengths.pop()
+
+        # Reserve enough space for the header, then place the datasets after it
+        header = {"frame_shape": frame_shape, "tile_shape": tile_shape, "nr_frames": nr_frames, "metadata": metadata, "datasets": {}}
+        header_length_estimate = len(json.dumps(header)) + 150 * len(datasets)
+        offset = round_up(len(_magic) + _header_length_bytes + header_length_estimate, _alignment)
+        for name, dtype in datasets.items():
+            dtype = np.dtype(dtype)
+            header["datasets"][name] = {"dtype": dtype.str, "offset": offset, "frame_shape": frame_shapes[name]}
+
+            # Size of this dataset on disk
+            nr_tiles = [round_up(size, tile) // tile for size, tile in zip(frame_shapes[name], tile_shape)]
+            nr_elements = nr_frames * np.prod(nr_tiles) * np.prod(tile_shape) * np.prod(frame_shapes[name][2:], dtype=int)
+            offset = round_up(offset + int(nr_elements) * dtype.itemsize, _alignment)
+
+        header_bytes = json.dumps(header).encode("utf-8")
+        assert len(_magic) + _header_length_bytes + len(header_bytes) <= header["datasets"][next(iter(datasets))]["offset"], "Stack container header does not fit in the reserved space"
+
+        # Write the header and allocate the full file size
+        with open(path, "wb") as file:
+            file.write(_magic)
+            file.write(len(header_bytes).to_bytes(_header_length_bytes, "little"))
+            file.write(header_bytes)
+            file.truncate(offset)
+
+        return cls(path, mode="r+")
+
+    def write(self, name, index, data):
+        """
+        Write a single frame `data` to the dataset `name` at position `index`.
+        """
+        assert self.mode != "r", f"Stack container `{self.path}` was opened read-only"
+        data = np.asarray(data)
+        frame_shape = self.frame_shapes[name]
+        assert data.shape == frame_shape, f"The data ({data.shape}) and dataset `{name}` ({frame_shape}) have incompatible shapes"
+
+        # Pad the data to a whole number of tiles
+        (nr_tiles_y, nr_tiles_x), (tile_y, tile_x) = self._nr_tiles(frame_shape), self.tile_shape
+        padded = np.zeros((nr_tiles_y * tile_y, nr_tiles_x * tile_x, *frame_shape[2:]), dtype=self.datasets[name])
+        padded[:data.shape[0], :data.shape[1]] = data
+
+        # Split the data into tiles and write them
+        tiles = padded.reshape((nr_tiles_y, tile_y, nr_tiles_x, tile_x, *frame_shape[2:])).swapaxes(1, 2)
+        self._data[name][index] = tiles
+
+    def flush(self):
+        """
+        Write any changes to disk.
+        """
+        for data in self._data.values():
+            data.flush()
+
+    def find(self, where=None):
+        """
+        Find the indices of the frames whose metadata match the conditions in
+        `where`, a dictionary with metadata columns as keys. Each value is
+        either a value that the column must be equal to, or a function that
+        takes the column and returns a boolean array.
+        For example: `where={"iso": 100, "exposure_time": lambda t: t <= 0.1}`.
+        """
+        match = np.ones(self.nr_frames, dtype=bool)
+        if where is not None:
+            for key, condition in where.items():
+                column = self.metadata[key]
+                match &= condition(column) if callable(condition) else (column == condition)
+        indices = np.where(match)[0]
+        return indices
+
+    def load(self, name, indices=None, selection=all_data):
+        """
+        Load the dataset `name` for the frames at `indices` (default: all),
+        only including the elements in `selection` within each frame.
+        Only the tiles overlapping with `selection` are read from disk.
+        """
+        if indices is None:
+            indices = np.arange(self.nr_frames)
+        indices = np.asarray(indices, dtype=int)
+
+        # Find the region of the frame to read, and the selection within it
+        frame_shape = self.frame_shapes[name]
+        selection = expand_selection(selection, len(frame_shape))
+        (y0, y1), relative_y = _selection_to_bounds(selection[0], frame_shape[0])
+        (x0, x1), relative_x = _selection_to_bounds(selection[1], frame_shape[1])
+
+        # Find the tiles overlapping with this region
+        tile_y, tile_x = self.tile_shape
+        ty0, ty1 = y0 // tile_y, max(round_up(y1, tile_y) // tile_y, y0 // tile_y + 1)
+        tx0, tx1 = x0 // tile_x, max(round_up(x1, tile_x) // tile_x, x0 // tile_x + 1)
+
+        # Read only these tiles, then combine them into one region per frame
+        tiles = self._data[name][indices, ty0:ty1, tx0:tx1]
+        region = tiles.swapaxes(2, 3).reshape((len(indices), (ty1-ty0) * tile_y, (tx1-tx0) * tile_x, *frame_shape[2:]))
+
+        # Apply the selection relative to the region that was read
+        region = region[:, y0-ty0*tile_y : y1-ty0*tile_y, x0-tx0*tile_x : x1-tx0*tile_x]
+        data = region[(slice(None), relative_y, relative_x, *selection[2:])]
+
+        return np.array(data)
+
+
+def load_dataset(path, name, retrieve_value="label", selection=all_data, where=None, **kwargs):
+    """
+    Load the dataset `name` from the stack container at `path`, similarly to
+    `io.load_npy` for loose .npy files. Returns a list of values for each frame
+    and the selected elements of the frames themselves.
+
+    `retrieve_value` is either the name of a metadata column, or a function
+    that is applied to the filename each frame would have as a loose .npy file
+    (e.g. `io.split_exposure_time`), with any additional **kwargs.
+
+    Only frames whose metadata match `where` (see `StackContainer.find`) are
+    loaded, in the same order as `io.load_npy` would load them.
+    """
+    container = StackContainer(path)
+
+    # Find the relevant frames, sorted by their filenames as loose .npy files
+    indices = container.find(where)
+    filenames = [f"{label}_{name}.npy" for label in container.metadata["label"][indices]]
+    indices = indices[np.argsort(filenames, kind="stable")]
+
+    data = container.load(name, indices=indices, selection=selection)
+
+    # Retrieve values from the metadata or from the original filenames
+    if callable(retrieve_value):
+        values = np.array([retrieve_value(Path(f"{label}_{name}.npy"), **kwargs) for label in container.metadata["label"][indices]])
+    else:
+        values = container.metadata[retrieve_value][indices]
+
+    return values, data
@@ -4,7 +4,7 @@ a map.
 """
 
 import numpy as np
-from .general import return_with_filename
+from .general import return_with_filename, calculation_dtype
 from . import io
 
 def fit_dark_current_linear(exposure_times, data):
@@ -39,27 +39,40 @@ def load_dark_current_map(root, return_filename=False):
     return return_with_filename(dark_current_map, filename, return_filename)
 
 
-def correct_dark_current_from_map(dark_current_map, exposure_time, data):
+def correct_dark_current_from_map(dark_current_map, exposure_time, data, out=None):
     """
     Apply a dark current correction from a dark current map `dark_current_map`,
     multiplied by an `exposure_time`, to any number of elements in `data`.
 
     `exposure_time` can be an iterable (list or array) of exposure times, in which
     case it must be the same length as `data`.
+
+    The result is calculated in the calibration data type (see
+    `general.set_calibration_dtype`). If an array `out` is given, the result is
+    written to it instead; this may be `data` itself to correct it in place.
     """
+    dtype = calculation_dtype(out)
+
     # Check if `exposure_time` is iterable
     try:
         _ = iter(exposure_time)
     # If `exposure_time` was not iterable, assume it is a constant value
     except TypeError:
-        dark_current = exposure_time * dark_current_map
+        dark_current = np.multiply(dark_current_map, exposure_time, dtype=dtype)
+        data_corrected = np.subtract(data, dark_current, out=out, dtype=dtype)
     # If `exposure time` was an iterable, check that it has the same number of
-    # elements as `data` and calculate the effective dark current for each
+    # elements as `data` and correct each element for its effective dark current
     else:
         assert len(exposure_time) == len(data), f"Exposure time is an iterable but has a different length ({len(exposure_time)}) than the data ({len(data)})."
-        dark_current = exposure_time[:, np.newaxis, np.newaxis] * dark_current_map
-    # In any case, correct the data
-    finally:
-        data_corrected = data - dark_current
+        if out is None:
+            data_corrected = np.array(data, dtype=dtype)
+        else:
+            data_corrected = out
+            if out is not data:
+                out[...] = data
+        dark_current = np.empty(np.shape(dark_current_map), dtype=dtype)
+        for data_element, exposure_time_element in zip(data_corrected, exposure_time):
+            np.multiply(dark_current_map, exposure_time_element, out=dark_current)
+            data_element -= dark_current
 
     return data_corrected
@@ -3,7 +3,7 @@ Code relating to gain calibration, such as loading gain maps.
 """
 
 import numpy as np
-from .general import return_with_filename
+from .general import return_with_filename, calculation_dtype
 from . import io
 
 
@@ -18,11 +18,15 @@ def load_gain_map(root, return_filename=False):
     return return_with_filename(gain_map, filename, return_filename)
 
 
-def convert_to_photoelectrons_from_map(gain_map, data):
+def convert_to_photoelectrons_from_map(gain_map, data, out=None):
     """
     Convert `data` from normalised ADU to photoelectrons using a map of gain
     in each pixel `gain_map`.
+
+    The result is calculated in the calibration data type (see
+    `general.set_calibration_dtype`). If an array `out` is given, the result is
+    written to it instead; this may be `data` itself to convert it in place.
     """
-    data_converted = data / gain_map
+    data_converted = np.divide(data, gain_map, out=out, dtype=calculation_dtype(out))
 
     return data_converted
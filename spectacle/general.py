@@ -1,7 +1,60 @@
-from scipy.ndimage.filters import gaussian_filter1d as gauss1d, gaussian_filter as gaussMd
-from scipy.optimize import curve_fit
 import numpy as np
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from . import raw
+
+# Empty slice that just selects all data - used as default argument
+all_data = np.s_[:]
+
+# Floating-point data type in which calibration maps are stored and calibrated
+# data are calculated - see `set_calibration_dtype`
+calibration_dtype = np.dtype(np.float64)
+
+
+def set_calibration_dtype(dtype):
+    """
+    Set the floating-point data type in which calibration maps are stored and
+    calibrated data are calculated. The default, `np.float64`, is the most
+    precise; `np.float32` halves the memory use and is faster.
+    """
+    global calibration_dtype
+    dtype = np.dtype(dtype)
+    assert dtype.kind == "f", f"Calibration data type must be a floating-point type, not `{dtype}`"
+    calibration_dtype = dtype
+
+
+def calculation_dtype(out=None):
+    """
+    Data type to calculate calibrated data in: that of `out` if an output
+    array is given, the calibration data type otherwise.
+    """
+    return calibration_dtype if out is None else out.dtype
+
+
+# scipy is slow to import, so the functions below only import it when they are first used
+def gauss1d(*args, **kwargs):
+    """
+    Apply a 1-D Gaussian kernel, using `scipy.ndimage.gaussian_filter1d`.
+    """
+    from scipy.ndimage import gaussian_filter1d
+    return gaussian_filter1d(*args, **kwargs)
+
+
+def gaussMd(*args, **kwargs):
+    """
+    Apply a multidimensional Gaussian kernel, using
+    `scipy.ndimage.gaussian_filter`.
+    """
+    from scipy.ndimage import gaussian_filter
+    return gaussian_filter(*args, **kwargs)
+
+
+def curve_fit(*args, **kwargs):
+    """
+    Fit a function to data, using `scipy.optimize.curve_fit`.
+    """
+    from scipy.optimize import curve_fit as scipy_curve_fit
+    return scipy_curve_fit(*args, **kwargs)
 
 
 def gauss_filter(D, sigma=5, **kwargs):
@@ -11,21 +64,158 @@ def gauss_filter(D, sigma=5, **kwargs):
     return gauss1d(D.astype(float), sigma, axis=1, **kwargs)
 
 
+def _gaussian_radius(sigma, truncate=4.0):
+    """
+    Radius (in elements) of a Gaussian kernel with standard deviation `sigma`,
+    truncated at `truncate` standard deviations, as in `gaussMd`.
+    """
+    return int(truncate * sigma + 0.5)
+
+
+def _gauss_filter_tiled(data, sigma, workers=1, truncate=4.0, **kwargs):
+    """
+    Apply a multidimensional Gaussian kernel to `data` in tiles, using
+    `workers` threads. The tiles are split along the axis on which the
+    overlap needed between them (the kernel radius) is relatively smallest,
+    and include that overlap, so the result is the same as for `gaussMd`
+    on the whole array.
+    """
+    radii = [_gaussian_radius(s, truncate) for s in sigma]
+    axes = [axis for axis in range(data.ndim) if data.shape[axis] >= 2*workers]
+    if workers <= 1 or not axes:
+        return gaussMd(data, sigma=sigma, truncate=truncate, **kwargs)
+
+    # Split the data into one tile per worker
+    axis = min(axes, key=lambda axis: radii[axis] / data.shape[axis])
+    length, radius = data.shape[axis], radii[axis]
+    bounds = np.linspace(0, length, workers+1).astype(int)
+    data_filtered = np.empty_like(data)
+
+    def filter_tile(start, stop):
+        # Filter the tile with enough overlap on both sides, then keep its own part
+        start_overlap, stop_overlap = max(start - radius, 0), min(stop + radius, length)
+        before = (slice(None),) * axis
+        tile_filtered = gaussMd(data[before + (slice(start_overlap, stop_overlap),)], sigma=sigma, truncate=truncate, **kwargs)
+        data_filtered[before + (slice(start, stop),)] = tile_filtered[before + (slice(start-start_overlap, stop-start_overlap),)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(filter_tile, bounds[:-1], bounds[1:]))
+
+    return data_filtered
+
+
+def _downsample(data, factors):
+    """
+    Downsample `data` by taking the mean in blocks of at most `factors`
+    elements along each axis. The blocks along each axis differ in size by at
+    most one element, so they are (almost) evenly spaced. Returns the
+    downsampled data and the positions of the block centres along each axis.
+    """
+    centres = []
+    for axis, factor in enumerate(factors):
+        length = data.shape[axis]
+        nr_blocks = -(-length // factor)
+        starts = (np.arange(nr_blocks) * length) // nr_blocks
+        counts = np.diff(np.append(starts, length))
+        shape = [1] * data.ndim
+        shape[axis] = len(counts)
+        data = np.add.reduceat(data, starts, axis=axis) / counts.reshape(shape).astype(data.dtype)
+        centres.append(starts + (counts - 1) / 2)
+    return data, centres
+
+
+def _upsample(data, centres, shape):
+    """
+    Upsample `data`, with elements at the positions `centres` along each axis,
+    to a given `shape` using linear interpolation.
+    """
+    for axis, (centres_axis, length) in enumerate(zip(centres, shape)):
+        if len(centres_axis) == 1:
+            data = np.repeat(data, length, axis=axis)
+            continue
+
+        # Interpolate between the nearest block centres on either side
+        positions = np.arange(length)
+        lower = np.clip(np.searchsorted(centres_axis, positions) - 1, 0, len(centres_axis) - 2)
+        weights = np.clip((positions - centres_axis[lower]) / (centres_axis[lower+1] - centres_axis[lower]), 0, 1)
+        weights_shape = [1] * data.ndim
+        weights_shape[axis] = length
+        weights = weights.reshape(weights_shape).astype(data.dtype)
+        data = np.take(data, lower, axis=axis) * (1 - weights) + np.take(data, lower + 1, axis=axis) * weights
+    return data
+
+
+def gauss_filter_fast(data, sigma=5, dtype=np.float32, workers=1, approximate=False, min_sigma_per_block=10, truncate=4.0, **kwargs):
+    """
+    Apply a multidimensional Gaussian kernel with standard deviation `sigma`
+    (one value or one per axis) to `data`, accounting for NaN values. The
+    result is calculated in data type `dtype`, in tiles across `workers`
+    threads (default: 1, since this may already run in parallel processes,
+    e.g. in `batch`); the result does not depend on the tiling.
+
+    NaN values are ignored by filtering the data (with NaN set to 0) and
+    their weights (0 for NaN, 1 otherwise) in a single pass, and dividing the
+    two. Without NaN values, only the data are filtered.
+
+    If `approximate` is True, the data are first downsampled by taking the
+    mean in blocks, with at least `min_sigma_per_block` standard deviations
+    per block along each axis, then filtered, and then upsampled again with
+    linear interpolation. This is much faster for large `sigma` (>= 2 *
+    `min_sigma_per_block`). For smooth data with sharp features, such as
+    flat-field or vignetting maps, the difference with the exact result is
+    <0.1% of the range of the smoothed data up to `sigma=40` by default; for
+    pure noise it can be a few percent. The approximation also fills in
+    regions of NaN values slightly further.
+
+    Any additional **kwargs are passed to `gaussMd`.
+    """
+    data = np.asanyarray(data)
+    sigma = [float(s) for s in np.broadcast_to(sigma, (data.ndim,))]
+
+    # Find NaN elements, which are given zero weight
+    nan = np.isnan(data) if data.dtype.kind in "fc" else np.zeros(data.shape, dtype=bool)
+    has_nan = nan.any()
+
+    # With NaN values, filter the data and weights together as two layers of one array
+    if has_nan:
+        values = np.empty((2, *data.shape), dtype=dtype)
+        values[0] = data
+        values[0][nan] = 0
+        np.logical_not(nan, out=values[1])
+        sigma_values = [0., *sigma]
+    else:
+        values = data.astype(dtype, copy=False)
+        sigma_values = sigma
+
+    # Approximate large kernels by filtering downsampled data
+    factors = [max(int(s // min_sigma_per_block), 1) for s in sigma_values]
+    if approximate and any(factor > 1 for factor in factors):
+        values_small, centres = _downsample(values, factors)
+        # The block mean is itself a smoothing step, with variance (f**2 - 1)/12
+        sigma_small = [np.sqrt(max(s**2 - (f**2 - 1) / 12, 0)) / f for s, f in zip(sigma_values, factors)]
+        values_small = _gauss_filter_tiled(values_small, sigma_small, workers=workers, truncate=truncate, **kwargs)
+        values_filtered = _upsample(values_small, centres, values.shape)
+    else:
+        values_filtered = _gauss_filter_tiled(values, sigma_values, workers=workers, truncate=truncate, **kwargs)
+
+    if not has_nan:
+        return values_filtered
+
+    # Divide the filtered data by the filtered weights
+    data_filtered, weights_filtered = values_filtered
+    with np.errstate(invalid="ignore", divide="ignore"):
+        data_filtered /= weights_filtered
+    return data_filtered
+
+
 def _gauss_nan(D, sigma=5, **kwargs):
     """
     Apply a multidimensional Gaussian kernel, accounting for NaN values.
     Reference: https://stackoverflow.com/a/36307291/2229219
-    """
-    V = D.copy()
-    V[D!=D] = 0
-    VV = gaussMd(V, sigma=sigma, **kwargs)
 
-    W = 0 * D.copy() + 1
-    W[D!=D] = 0
-    WW = gaussMd(W, sigma=sigma, **kwargs)
-
-    Z=VV/WW
-    return Z
+    See `gauss_filter_fast`, which this uses.
+    """
+    return gauss_filter_fast(D, sigma=sigma, dtype=np.float64, **kwargs)
 
 
 def gauss_filter_multidimensional(data, sigma=5, **kwargs):
@@ -33,11 +223,14 @@ def gauss_filter_multidimensional(data, sigma=5, **kwargs):
     Apply a multidimensional Gaussian kernel, accounting for NaN values
     if necessary.
 
-    Select `gaussMd` or `_gauss_nan` depending on if NaN data are present
-    in the given `data_element`.
+    This uses `gauss_filter_fast`, in the data type of `data` if that is a
+    floating-point type and `np.float64` otherwise, unless a different
+    `dtype` is given. Any additional **kwargs (e.g. `dtype`, `approximate`)
+    are passed to `gauss_filter_fast`.
     """
-    func = _gauss_nan if np.isnan(data).any() else gaussMd
-    data_gauss = func(data, sigma=sigma, **kwargs)
+    data = np.asanyarray(data)
+    kwargs.setdefault("dtype", data.dtype if data.dtype.kind == "f" else np.float64)
+    data_gauss = gauss_filter_fast(data, sigma=sigma, **kwargs)
 
     return data_gauss
 
@@ -112,6 +305,88 @@ def RMS(x, **kwargs):
     return np.sqrt(np.mean(x**2, **kwargs))
 
 
+def curve_fit_batched(model, jacobian, x, y, p0, max_iterations=100, ftol=1.49012e-8, xtol=1.49012e-8):
+    """
+    Fit a `model` to many data sets at once, using the Levenberg-Marquardt
+    algorithm with an analytic `jacobian`. This gives the same results as
+    using `curve_fit` on each data set separately, within the fitting
+    tolerance, but is much faster.
+
+    `y` contains one data set per column (shape [N, M]); `x` must broadcast
+    against it, e.g. with shape [N, 1]. NaN values in `y` are ignored.
+    `model(x, *parameters)` and `jacobian(x, *parameters)`, with one array of
+    M values per parameter, must return the model values (shape [N, M]) and
+    a list of their derivatives to each parameter (each shape [N, M]),
+    respectively. `p0` are the initial parameters, one value per parameter or
+    one array of M values per parameter.
+
+    A fit has converged when the relative decrease in the sum of squared
+    residuals is less than `ftol`, or when the relative change in each
+    parameter in the proposed step is less than `xtol` (even if the step is
+    rejected), as in `curve_fit`.
+
+    Returns the best-fitting parameters (shape [nr_parameters, M]) and a
+    boolean array that is True for the fits that converged.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~np.isnan(y)
+    nr_parameters = len(p0)
+    nr_fits = y.shape[1]
+    parameters = np.array([np.broadcast_to(p, (nr_fits,)) for p in p0], dtype=np.float64)
+    diagonal = np.arange(nr_parameters)
+
+    # Residuals and sum of squared residuals for each data set, ignoring NaN values
+    def calculate_residuals(parameters_here, fits):
+        residuals = np.where(valid[:, fits], y[:, fits] - model(x, *parameters_here), 0)
+        return residuals, np.sum(residuals**2, axis=0)
+
+    residuals, sum_squares = calculate_residuals(parameters, np.s_[:])
+    damping = np.full(nr_fits, 1e-3)
+    active = np.ones(nr_fits, dtype=bool)
+    converged = np.zeros(nr_fits, dtype=bool)
+
+    for iteration in range(max_iterations):
+        fits = np.nonzero(active)[0]
+        if len(fits) == 0:
+            break
+        parameters_here = parameters[:, fits]
+
+        # Normal equations J^T J and J^T r for each active data set
+        J = np.stack(np.broadcast_arrays(*jacobian(x, *parameters_here))) * valid[:, fits]
+        JTJ = np.einsum("inm,jnm->mij", J, J)
+        JTr = np.einsum("inm,nm->mi", J, residuals[:, fits])
+
+        # Solve the damped normal equations for each data set
+        JTJ_diagonal = JTJ[:, diagonal, diagonal]
+        JTJ[:, diagonal, diagonal] += damping[fits, np.newaxis] * np.where(JTJ_diagonal > 0, JTJ_diagonal, 1)
+        step = np.linalg.solve(JTJ, JTr[..., np.newaxis])[..., 0].T
+
+        # Accept the steps that improve the fit, and change the damping accordingly
+        parameters_new = parameters_here + step
+        residuals_new, sum_squares_new = calculate_residuals(parameters_new, fits)
+        better = sum_squares_new <= sum_squares[fits]
+
+        # Fits have converged when the proposed step is negligible, whether or not it is accepted,
+        # since a rejected step may only increase the residuals through rounding errors
+        small_step = np.all(np.abs(step) <= xtol * (np.abs(parameters_here) + xtol), axis=0)
+        small_decrease = better & (sum_squares[fits] - sum_squares_new <= ftol * sum_squares[fits])
+        done = small_step | small_decrease
+
+        improved = fits[better]
+        parameters[:, improved] = parameters_new[:, better]
+        residuals[:, improved] = residuals_new[:, better]
+        sum_squares[improved] = sum_squares_new[better]
+        damping[fits] = np.where(better, np.maximum(damping[fits] / 10, 1e-12), damping[fits] * 10)
+
+        # Stop fitting data sets that have converged or cannot be improved any further
+        # Fits reaching the maximum damping with a negligible step have converged in the check above
+        converged[fits[done]] = True
+        active[fits[done]] = False
+        active[damping > 1e12] = False
+
+    return parameters, converged
+
+
 def uncertainty_from_covariance(covariance):
     """
     Calculate a naive uncertainty estimate from a covariance matrix.
@@ -132,10 +407,47 @@ def correlation_from_covariance(covariance):
     return correlation
 
 
+def round_up(value, multiple):
+    """
+    Round `value` up to the nearest multiple of `multiple`.
+    """
+    return -(-value // multiple) * multiple
+
+
+def expand_selection(selection, ndim):
+    """
+    Expand a numpy selection (slice object or tuple) `selection` into a tuple
+    with one element per axis, for an array with `ndim` axes.
+    """
+    if not isinstance(selection, tuple):
+        selection = (selection,)
+
+    # Compare by identity, since the selection may contain index arrays
+    nr_ellipsis = sum(item is Ellipsis for item in selection)
+    assert nr_ellipsis <= 1, f"Selection `{selection}` contains more than one Ellipsis"
+    assert not any(item is None for item in selection), f"Selection `{selection}` cannot add new axes"
+
+    # Replace an Ellipsis with as many full slices as necessary
+    if nr_ellipsis:
+        index = [item is Ellipsis for item in selection].index(True)
+        nr_missing = ndim - (len(selection) - 1)
+        selection = selection[:index] + (all_data,) * nr_missing + selection[index+1:]
+    # Without an Ellipsis, the selection applies to the first axes
+    else:
+        selection = selection + (all_data,) * (ndim - len(selection))
+
+    assert len(selection) == ndim, f"Selection `{selection}` has too many elements for data with {ndim} axes"
+
+    return selection
+
+
 def generate_XY(shape):
     """
     Given a `shape`, generate a meshgrid of index values in both directions as
     well as a combination.
+
+    This makes full-size arrays; `coordinate_grid` and the functions based on
+    it use much less memory.
     """
     x = np.arange(shape[1])
     y = np.arange(shape[0])
@@ -144,13 +456,117 @@ def generate_XY(shape):
     return X, Y, XY
 
 
+def coordinate_grid(shape, selection=all_data, dtype=np.float64):
+    """
+    Generate open (broadcastable) coordinate arrays for data of a given
+    `shape`, like `np.ogrid`: the row indices `Y`, with shape [y, 1], and the
+    column indices `X`, with shape [1, x]. If a `selection` of slices is given
+    (e.g. `np.s_[100:200, 300:400]`), only the coordinates of that part of the
+    data are generated.
+    """
+    rows, columns = expand_selection(selection, 2)
+    assert isinstance(rows, slice) and isinstance(columns, slice), f"Selection `{selection}` must consist of slices"
+    Y = np.arange(shape[-2], dtype=dtype)[rows, np.newaxis]
+    X = np.arange(shape[-1], dtype=dtype)[np.newaxis, columns]
+    return Y, X
+
+
+def evaluate_on_grid(function, shape, selection=all_data, dtype=np.float64, rows_per_chunk=256):
+    """
+    Evaluate `function(Y, X)` on the open coordinate arrays of data of a given
+    `shape`, or the part given by `selection` (see `coordinate_grid`). This is
+    done in chunks of `rows_per_chunk` rows, so no full-size coordinate or
+    intermediate arrays are made. Returns an array of data type `dtype`.
+    """
+    # Selections other than slices are taken from the full result
+    rows, columns = expand_selection(selection, 2)
+    if not (isinstance(rows, slice) and isinstance(columns, slice)):
+        return evaluate_on_grid(function, shape, dtype=dtype, rows_per_chunk=rows_per_chunk)[selection]
+
+    Y, X = coordinate_grid(shape, selection, dtype=dtype)
+    result = np.empty((Y.shape[0], X.shape[1]), dtype=dtype)
+    for start in range(0, len(Y), rows_per_chunk):
+        result[start:start+rows_per_chunk] = function(Y[start:start+rows_per_chunk], X)
+
+    return result
+
+
+def radius(shape, center=None, selection=all_data, dtype=np.float64, **kwargs):
+    """
+    Calculate the distance in pixels from a `center` (x, y) for each element of
+    data of a given `shape`, or the part given by `selection`. By default, the
+    center of the data is used. Any additional **kwargs are passed to
+    `evaluate_on_grid`.
+    """
+    x_center, y_center = (shape[-1]/2, shape[-2]/2) if center is None else center
+    distance = evaluate_on_grid(lambda Y, X: np.sqrt((X - x_center)**2 + (Y - y_center)**2), shape, selection, dtype=dtype, **kwargs)
+    return distance
+
+
+def optical_center(shape, cx_hat=0.5, cy_hat=0.5):
+    """
+    Convert an optical center (`cx_hat`, `cy_hat`), in normalized units (0-1)
+    relative to the top left corner of data of a given `shape`, to absolute
+    (pixel) units. Also returns the euclidean distance from the optical center
+    to the farthest corner, in absolute (pixel) units.
+    """
+    x0, y0 = 0, 0 # top left corner
+    x1, y1 = shape[-1], shape[-2]  # bottom right corner
+    cx = x0 + cx_hat * (x1 - x0)
+    cy = y0 + cy_hat * (y1 - y0)
+    mx = max([abs(x0 - cx), abs(x1 - cx)])
+    my = max([abs(y0 - cy), abs(y1 - cy)])
+    m = np.sqrt(mx**2 + my**2)
+    return cx, cy, m
+
+
+def normalised_radius(shape, cx_hat=0.5, cy_hat=0.5, selection=all_data, dtype=np.float64, **kwargs):
+    """
+    Calculate the normalized euclidean distance (0-1) from an optical center
+    (`cx_hat`, `cy_hat`, see `optical_center`) for each element of data of a
+    given `shape`, or the part given by `selection`, relative to the distance
+    to the farthest corner. Any additional **kwargs are passed to
+    `evaluate_on_grid`.
+    """
+    cx, cy, m = optical_center(shape, cx_hat, cy_hat)
+    distance = evaluate_on_grid(lambda Y, X: 1/m * np.sqrt((X - cx)**2 + (Y - cy)**2), shape, selection, dtype=dtype, **kwargs)
+    return distance
+
+
+def coordinate_grid_RGBG2(shape, bayer_map, dtype=np.float64):
+    """
+    Generate open coordinate arrays (see `coordinate_grid`) for each of the
+    Bayer RGBG2 channels of data of a given `shape`, i.e. the coordinates
+    of the elements of the demosaicked data. `bayer_map` is a Bayer map or
+    BayerPattern object. Returns a list of (`Y`, `X`) for each channel.
+    """
+    slices = raw.as_bayer_pattern(bayer_map).channel_slices()
+    return [coordinate_grid(shape, s, dtype=dtype) for s in slices]
+
+
+def radius_RGBG2(shape, bayer_map, center=None, dtype=np.float64, **kwargs):
+    """
+    Calculate the distance in pixels from a `center` (x, y) for each element of
+    data of a given `shape`, split into the Bayer RGBG2 channels like
+    demosaicked data (see `radius`). `bayer_map` is a Bayer map or
+    BayerPattern object.
+    """
+    slices = raw.as_bayer_pattern(bayer_map).channel_slices()
+    distances = np.stack([radius(shape, center, s, dtype=dtype, **kwargs) for s in slices])
+    return distances
+
+
 def distances_px(array):
     """
     Calculate the distance from the center of `array` for each element.
+
+    `X` and `Y` are returned as read-only broadcast views, which do not use
+    any memory.
     """
-    X, Y, _ = generate_XY(array.shape)
-    x_center, y_center = array.shape[1]/2, array.shape[0]/2
-    distance = np.sqrt((X - x_center)**2 + (Y - y_center)**2)
+    shape = array.shape[-2:]
+    X = np.broadcast_to(np.arange(shape[1]), shape)
+    Y = np.broadcast_to(np.arange(shape[0])[:, np.newaxis], shape)
+    distance = radius(shape)
     return X, Y, distance
 
 
@@ -1,18 +1,30 @@
-import rawpy
-import exifread
 import numpy as np
 import os
+import json
+import sqlite3
+from threading import Lock
 from string import ascii_letters
 from pathlib import Path
-from matplotlib import pyplot as plt
-from .camera import load_camera, find_root_folder, load_json, write_json
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 from .general import find_matching_file
+from . import container
+from .raw_cache import RawCache
 
-# Default save folder for results
-results_folder = Path.home() / "SPECTACLE_results"
-if not results_folder.exists():
-    os.makedirs(results_folder)
-    print(f"Created SPECTACLE results folder: {results_folder}")
+# Default save folder for results - created when first used, see `get_results_folder`
+_results_folder = Path.home() / "SPECTACLE_results"
+
+# Persistent cache for EXIF data, see `load_exif_fast` - default: in the results folder
+exif_cache_file = None
+_exif_cache_connection = None
+_exif_cache_lock = Lock()
+
+# Decoded RAW cache, disabled by default - see `enable_raw_cache`
+raw_cache = None
+
+# Functions from the `camera` module that are also available here - these are
+# looked up when first used, because `camera` itself imports this module
+_camera_functions = ["load_camera", "find_root_folder", "load_json", "write_json", "enable_camera_cache", "disable_camera_cache"]
 
 def path_from_input(argv):
     """
@@ -24,21 +36,75 @@ def path_from_input(argv):
         return [Path(a) for a in argv[1:]]
 
 
+def get_results_folder():
+    """
+    Get the default save folder for results, creating it if it does not exist
+    yet. This is also available as `io.results_folder`.
+    """
+    if not _results_folder.exists():
+        os.makedirs(_results_folder)
+        print(f"Created SPECTACLE results folder: {_results_folder}")
+    return _results_folder
+
+
+def __getattr__(name):
+    """
+    Provide `results_folder` as a module attribute, without creating the
+    folder when the module is imported, as well as the functions in
+    `_camera_functions`.
+    """
+    if name == "results_folder":
+        return get_results_folder()
+    if name in _camera_functions:
+        from . import camera
+        return getattr(camera, name)
+    raise AttributeError(f"module `{__name__}` has no attribute `{name}`")
+
+
 def load_raw_file(filename):
     """
     Load a raw file using rawpy's `imread` function. Return the rawpy object.
     """
+    import rawpy  # Slow to import, so only done when used
+
     # Convert filename to str because rawpy does not support Path
     filename_as_str = str(filename)
     img = rawpy.imread(filename_as_str)
     return img
 
 
+def enable_raw_cache(folder=None, **kwargs):
+    """
+    Enable the decoded RAW cache (see `raw_cache.RawCache`) for
+    `load_raw_image`, `load_raw_colors`, and `load_raw_black_level`.
+    By default, the cache is stored in the results folder.
+    Any additional **kwargs (e.g. `max_size`) are passed to `RawCache`.
+    """
+    global raw_cache
+    if folder is None:
+        folder = get_results_folder()/"raw_cache"
+    raw_cache = RawCache(folder, **kwargs)
+    return raw_cache
+
+
+def disable_raw_cache():
+    """
+    Disable the decoded RAW cache. Files that were already cached are kept.
+    """
+    global raw_cache
+    raw_cache = None
+
+
 def load_raw_image(filename):
     """
     Load a raw file using rawpy's `imread` function. Return only the image
     data.
+
+    If the decoded RAW cache is enabled, the data are loaded from the cache
+    as a read-only memory-mapped array instead.
     """
+    if raw_cache is not None:
+        return raw_cache.load(filename)["raw_image"]
     img = load_raw_file(filename)
     return img.raw_image
 
@@ -47,11 +113,29 @@ def load_raw_colors(filename):
     """
     Load a raw file using rawpy's `imread` function. Return only the Bayer
     colour data.
+
+    If the decoded RAW cache is enabled, the data are loaded from the cache
+    as a read-only memory-mapped array instead.
     """
+    if raw_cache is not None:
+        return raw_cache.load(filename)["raw_colors"]
     img = load_raw_file(filename)
     return img.raw_colors
 
 
+def load_raw_black_level(filename):
+    """
+    Load a raw file using rawpy's `imread` function. Return only the black
+    level per channel.
+
+    If the decoded RAW cache is enabled, the data are loaded from the cache.
+    """
+    if raw_cache is not None:
+        return np.array(raw_cache.load(filename)["black_level_per_channel"])
+    img = load_raw_file(filename)
+    return np.array(img.black_level_per_channel)
+
+
 def load_raw_image_postprocessed(filename, **kwargs):
     """
     Load a raw file using rawpy's `imread` function and post-process it.
@@ -62,27 +146,68 @@ def load_raw_image_postprocessed(filename, **kwargs):
     return img_post
 
 
-def load_raw_image_multi(folder, pattern="*.dng"):
+def _load_into_array(load_func, filename, arrs, index):
     """
-    Load many raw files simultaneously and put their image data in a single
-    array.
+    Load a file `filename` using `load_func` and put its data directly into
+    `arrs[index]`, without keeping an intermediate copy.
     """
+    arrs[index] = load_func(filename)
 
-    # Find all files in `folder` matching the given pattern `pattern`
-    files = list(folder.glob(pattern))
+
+def _load_multi(files, load_func, dtype, workers=1, verbose=False):
+    """
+    Load the image data from `files` using `load_func` and put them in a single
+    array, in the same order as `files`.
+
+    If `workers` is more than 1, the files are decoded in a pool of threads.
+    Each thread writes directly into the same pre-allocated output array.
+    Both rawpy (LibRaw) and pyplot (Pillow) release the GIL while decoding,
+    so this uses multiple cores. If `verbose` is True, the decoding
+    throughput is printed.
+    """
+    start = perf_counter()
 
     # Load the first file to get the shape of the images
-    file0 = load_raw_file(files[0])
+    data0 = load_func(files[0])
 
     # Create an array to fit the image contained in each file
-    arrs = np.empty((len(files), *file0.raw_image.shape), dtype=np.uint16)
+    arrs = np.empty((len(files), *data0.shape), dtype=dtype)
 
     # Include the already loaded first image in the array
-    arrs[0] = file0.raw_image
+    arrs[0] = data0
+    del data0
 
     # Include the image data from the other files in the array
-    for j, file in enumerate(files[1:], 1):
-        arrs[j] = load_raw_image(file)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs = [executor.submit(_load_into_array, load_func, file, arrs, j) for j, file in enumerate(files[1:], 1)]
+            # Retrieve the results to raise any errors that occurred in a thread
+            for job in jobs:
+                job.result()
+    else:
+        for j, file in enumerate(files[1:], 1):
+            _load_into_array(load_func, file, arrs, j)
+    duration = perf_counter() - start
+
+    # Report the decoding throughput
+    if verbose:
+        print(f"Decoded {len(files)} files in {duration:.1f} s ({len(files)/duration:.1f} frames/s, {workers} worker(s))")
+
+    return arrs
+
+
+def load_raw_image_multi(folder, pattern="*.dng", workers=1, verbose=False):
+    """
+    Load many raw files simultaneously and put their image data in a single
+    array, sorted by filename.
+
+    If `workers` is more than 1, the files are decoded in parallel. If
+    `verbose` is True, the decoding throughput is printed.
+    """
+    # Find all files in `folder` matching the given pattern `pattern`
+    files = sorted(folder.glob(pattern))
+
+    arrs = _load_multi(files, load_raw_image, np.uint16, workers=workers, verbose=verbose)
 
     return arrs
 
@@ -92,31 +217,23 @@ def load_jpg_image(filename):
     Load a raw file using pyplot's `imread` function. Return only the image
     data.
     """
-    img = plt.imread(filename)
+    from matplotlib.image import imread
+    img = imread(filename)
     return img
 
 
-def load_jpg_multi(folder, pattern="*.jp*g"):
+def load_jpg_multi(folder, pattern="*.jp*g", workers=1, verbose=False):
     """
     Load many jpg files simultaneously and put their image data in a single
-    array.
-    """
+    array, sorted by filename.
 
+    If `workers` is more than 1, the files are decoded in parallel. If
+    `verbose` is True, the decoding throughput is printed.
+    """
     # Find all files in `folder` matching the given pattern `pattern`
-    files = list(folder.glob(pattern))
-
-    # Load the first file to get the shape of the images
-    img0 = load_jpg_image(files[0])
-
-    # Create an array to fit the image contained in each file
-    arrs = np.empty((len(files), *img0.shape), dtype=np.uint8)
+    files = sorted(folder.glob(pattern))
 
-    # Include the already loaded first image in the array
-    arrs[0] = img0
-
-    # Include the image data from the other files in the array
-    for j, file in enumerate(files[1:], 1):
-        arrs[j] = load_jpg_image(file)
+    arrs = _load_multi(files, load_jpg_image, np.uint8, workers=workers, verbose=verbose)
 
     return arrs
 
@@ -126,11 +243,96 @@ def load_exif(filename):
     Load the EXIF data in an image using exifread's `process_file` function.
     Return all EXIF data.
     """
+    import exifread  # Slow to import, so only done when used
     with open(filename, "rb") as f:
         exif = exifread.process_file(f)
     return exif
 
 
+def exif_tag_value(tag):
+    """
+    Convert an exifread tag `tag` into a simple Python value: a number for
+    single numerical values, a list for multiple values, and a string otherwise.
+    """
+    values = tag.values
+    if isinstance(values, str):
+        return values.strip()
+    if isinstance(values, bytes):
+        return tag.printable
+
+    # Convert ratios (e.g. exposure times of 1/1000 s) to floats; undefined ratios (0/0) become NaN
+    values = [(value.num / value.den if value.den != 0 else np.nan) if hasattr(value, "den") else value for value in values]
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+def _load_exif_header(filename, stop_tag=None):
+    """
+    Load the EXIF data in an image without maker notes or thumbnails, which
+    are slow to parse, and convert them to simple Python values.
+    Processing stops after `stop_tag` (default: none).
+    """
+    import exifread  # Slow to import, so only done when used
+    if stop_tag is None:
+        stop_tag = exifread.DEFAULT_STOP_TAG
+    with open(filename, "rb") as f:
+        exif = exifread.process_file(f, details=False, stop_tag=stop_tag)
+    exif = {key: exif_tag_value(tag) for key, tag in exif.items() if hasattr(tag, "values")}
+    return exif
+
+
+def _exif_cache():
+    """
+    Open the persistent EXIF cache database, creating it if necessary.
+    The connection is opened once and then shared between threads.
+    """
+    global _exif_cache_connection
+    with _exif_cache_lock:
+        if _exif_cache_connection is None:
+            filename = get_results_folder()/"exif_cache.sqlite" if exif_cache_file is None else exif_cache_file
+            _exif_cache_connection = sqlite3.connect(str(filename), check_same_thread=False)
+            _exif_cache_connection.execute("CREATE TABLE IF NOT EXISTS exif (path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, tags TEXT NOT NULL)")
+    return _exif_cache_connection
+
+
+def load_exif_fast(filename, cache=True, stop_tag=None):
+    """
+    Load the EXIF data in an image, skipping maker notes and thumbnails.
+    Return a dictionary of simple Python values (see `exif_tag_value`), e.g.
+    `exif["EXIF ExposureTime"]` is a float.
+
+    If `cache` is True, the results are stored in a persistent cache
+    (`exif_cache_file`, by default in the results folder), keyed on the
+    absolute path, modification time, and size of the file. Files that have
+    not changed are then not read again. Reads that stop early (at `stop_tag`)
+    only give part of the header, so they are not stored in the cache, but
+    they can be served from a complete entry.
+    """
+    # Without a cache, simply read the file
+    if not cache:
+        return _load_exif_header(filename, stop_tag=stop_tag)
+
+    path = str(Path(filename).absolute())
+    stat = os.stat(path)
+    connection = _exif_cache()
+
+    # Look for an entry for this file that is still up to date
+    with _exif_cache_lock:
+        row = connection.execute("SELECT tags FROM exif WHERE path = ? AND mtime = ? AND size = ?", (path, stat.st_mtime, stat.st_size)).fetchone()
+    if row is not None:
+        return json.loads(row[0])
+
+    # If there is none, read the file and add it to the cache if it is complete
+    exif = _load_exif_header(filename, stop_tag=stop_tag)
+    if stop_tag is not None:
+        return exif
+    with _exif_cache_lock, connection:
+        connection.execute("INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?)", (path, stat.st_mtime, stat.st_size, json.dumps(exif, default=str)))
+
+    return exif
+
+
 def absolute_filename(file):
     """
     Return the absolute filename of a given Path object `file`.
@@ -138,6 +340,16 @@ def absolute_filename(file):
     return file.absolute()
 
 
+def load_npy_shape(filename):
+    """
+    Find the shape of the array stored in a .npy (NumPy binary) file
+    `filename`. Only the file header is read, not the data themselves.
+    """
+    # Memory-mapping a file only reads its header until the data are accessed
+    array = np.load(filename, mmap_mode="r")
+    return array.shape
+
+
 def expected_array_size(folder, pattern):
     """
     Find the required array size when loading files from `folder` that follow
@@ -146,22 +358,35 @@ def expected_array_size(folder, pattern):
     # Make sure `folder` is a Path-like object
     folder = Path(folder)
     files = sorted(folder.glob(pattern))
-    array = np.load(files[0])
-    return np.array(array.shape)
+    shape = load_npy_shape(files[0])
+    return np.array(shape)
 
 
-def load_npy(folder, pattern, retrieve_value=absolute_filename, selection=np.s_[:], **kwargs):
+def load_npy(folder, pattern, retrieve_value=absolute_filename, selection=np.s_[:], mmap_mode="r", **kwargs):
     """
     Load a series of .npy (NumPy binary) files from `folder` following a
     pattern `pattern`. Returns the contents of the .npy files as well as a
     list of values based on their parsing their filenames with a function
     given in the `retrieve_value` keyword. Only return array elements included
     in `selection` (default: all).
+
+    By default, the files are memory-mapped (`mmap_mode="r"`), so only the
+    elements included in `selection` are read from disk. Use `mmap_mode=None`
+    to read each file in full instead.
     """
     # Make sure `folder` is a Path-like object
     folder = Path(folder)
     files = sorted(folder.glob(pattern))
-    stacked = np.stack([np.load(f)[selection] for f in files])
+
+    # Load the selected elements of the first file to get the output shape
+    first = np.load(files[0], mmap_mode=mmap_mode)[selection]
+
+    # Create an array to fit the selected elements of each file, and fill it
+    stacked = np.empty((len(files), *first.shape), dtype=first.dtype)
+    stacked[0] = first
+    for j, f in enumerate(files[1:], 1):
+        stacked[j] = np.load(f, mmap_mode=mmap_mode)[selection]
+
     values = np.array([retrieve_value(f, **kwargs) for f in files])
     return values, stacked
 
@@ -222,8 +447,15 @@ def load_means(folder, **kwargs):
 
     Load the files in `folder` that follow the pattern `*_mean.npy`.
     Any additional **kwargs are passed to `load_npy`.
+
+    If `folder` is a stack container file, the `mean` dataset is loaded from
+    it instead. Any additional **kwargs are then passed to
+    `container.load_dataset`.
     """
-    values, means = load_npy(folder, "*_mean.npy", **kwargs)
+    if container.is_stack_container(folder):
+        values, means = container.load_dataset(folder, "mean", **kwargs)
+    else:
+        values, means = load_npy(folder, "*_mean.npy", **kwargs)
     return values, means
 
 
@@ -233,8 +465,15 @@ def load_jmeans(folder, **kwargs):
 
     Load the files in `folder` that follow the pattern `*_jmean.npy`.
     Any additional **kwargs are passed to `load_npy`.
+
+    If `folder` is a stack container file, the `jmean` dataset is loaded from
+    it instead. Any additional **kwargs are then passed to
+    `container.load_dataset`.
     """
-    values, means = load_npy(folder, "*_jmean.npy", **kwargs)
+    if container.is_stack_container(folder):
+        values, means = container.load_dataset(folder, "jmean", **kwargs)
+    else:
+        values, means = load_npy(folder, "*_jmean.npy", **kwargs)
     return values, means
 
 
@@ -244,8 +483,15 @@ def load_stds(folder, **kwargs):
 
     Load the files in `folder` that follow the pattern `*_stds.npy`.
     Any additional **kwargs are passed to `load_npy`.
+
+    If `folder` is a stack container file, the `stds` dataset is loaded from
+    it instead. Any additional **kwargs are then passed to
+    `container.load_dataset`.
     """
-    values, stds = load_npy(folder, "*_stds.npy", **kwargs)
+    if container.is_stack_container(folder):
+        values, stds = container.load_dataset(folder, "stds", **kwargs)
+    else:
+        values, stds = load_npy(folder, "*_stds.npy", **kwargs)
     return values, stds
 
 
@@ -255,8 +501,15 @@ def load_jstds(folder, **kwargs):
 
     Load the files in `folder` that follow the pattern `*_jstds.npy`.
     Any additional **kwargs are passed to `load_npy`.
+
+    If `folder` is a stack container file, the `jstds` dataset is loaded from
+    it instead. Any additional **kwargs are then passed to
+    `container.load_dataset`.
     """
-    values, stds = load_npy(folder, "*_jstds.npy", **kwargs)
+    if container.is_stack_container(folder):
+        values, stds = container.load_dataset(folder, "jstds", **kwargs)
+    else:
+        values, stds = load_npy(folder, "*_jstds.npy", **kwargs)
     return values, stds
 
 
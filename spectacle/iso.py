@@ -4,8 +4,7 @@ look-up tables.
 """
 
 import numpy as np
-from scipy.optimize import curve_fit
-from .general import Rsquare, return_with_filename
+from .general import Rsquare, curve_fit, return_with_filename, calculation_dtype
 from . import io
 
 
@@ -89,24 +88,24 @@ def fit_iso_normalisation_relation(isos, ratios, ratios_errs=None, min_iso=50, m
     return model_type, model, R2, parameters, errors
 
 
-def normalise_iso(lookup_table, isos, data):
+def normalise_iso(lookup_table, isos, data, out=None):
     """
     Normalise data for ISO speed. `isos` can be an iterable of the same length as
     `data` or a single value, which is then used for all data elements.
+
+    The result is calculated in the calibration data type (see
+    `general.set_calibration_dtype`). If an array `out` is given, the result is
+    written to it instead; this may be `data` itself to normalise it in place.
     """
     # Get the normalisation from the lookup table
-    normalisation = lookup_table[1, isos]
+    normalisation = np.asarray(lookup_table[1, isos])
 
-    # If `normalisation` is a single value, simply divide
-    try:
-        data_normalised = data / normalisation
-    # If this does not work, assume `normalisation` is iterable
-    except ValueError:
-        # Numpy's broadcasting works when the first axis of `data`, which has
-        # the same length as `normalisation`, is at the end
-        data_normalised = np.moveaxis(data.copy(), 0, -1)
-        data_normalised /= normalisation
-        data_normalised = np.moveaxis(data_normalised, -1, 0)
+    # If `normalisation` is iterable, add axes so it is broadcast along the
+    # first axis of `data`, which has the same length as `normalisation`
+    if normalisation.ndim > 0:
+        normalisation = normalisation.reshape((-1,) + (1,) * (np.ndim(data) - 1))
+
+    data_normalised = np.divide(data, normalisation, out=out, dtype=calculation_dtype(out))
 
     return data_normalised
 
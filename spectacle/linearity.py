@@ -1,7 +1,8 @@
 import numpy as np
-from scipy.stats import pearsonr
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-from .general import Rsquare, curve_fit, RMS
+from .general import Rsquare, curve_fit, curve_fit_batched, RMS
 from . import io
 
 # minimum Pearson r value to be considered linear (see SPECTACLE paper)
@@ -60,15 +61,33 @@ def sRGB(I, normalization=255, gamma=2.4):
     `gamma` are parameters.
     """
     u = I/normalization
-    u_small = np.where(u < 0.0031308)
-    u_large = np.where(u >=0.0031308)
-    u[u_small] = 12.92 * u[u_small]
-    u[u_large] = 1.055 * u[u_large]**(1/gamma) - 0.055
+    with np.errstate(invalid="ignore"):
+        u = np.where(u < 0.0031308, 12.92 * u, 1.055 * u**(1/gamma) - 0.055)
     u *= 255.
     u = np.clip(u, 0, 255)
     return u
 
 
+def sRGB_jacobian(I, normalization=255, gamma=2.4):
+    """
+    Calculate the derivatives of the sRGB-like response (see `sRGB`) to an
+    intensity `I` with respect to the `normalization` and `gamma`.
+    Where the response is clipped, both derivatives are 0.
+    """
+    u = I/normalization
+    linear = u < 0.0031308
+    with np.errstate(invalid="ignore", divide="ignore"):
+        power = u**(1/gamma)
+        response = 255. * np.where(linear, 12.92 * u, 1.055 * power - 0.055)
+        d_normalization = np.where(linear, -255. * 12.92 * u, -255. * 1.055 / gamma * power) / normalization
+        d_gamma = np.where(linear, 0., -255. * 1.055 * power * np.log(u) / gamma**2)
+
+    clipped = (response < 0) | (response > 255)
+    d_normalization = np.where(clipped, 0., d_normalization)
+    d_gamma = np.where(clipped, 0., d_gamma)
+    return [d_normalization, d_gamma]
+
+
 def sRGB_inverse(I, normalization=255, gamma=2.4):
     """
     Apply an inverse sRGB-like response to data `I`. The `normalization` and
@@ -83,62 +102,84 @@ def sRGB_inverse(I, normalization=255, gamma=2.4):
     return u
 
 
-def fit_sRGB_generic(intensities, jmeans):
+def fit_sRGB_generic(intensities, jmeans, block_size=2**16):
     """
     Fit a generic sRGB profile (normalization and gamma as free parameters) to
     `intensities` and responses `jmeans`.
 
     Returns the best-fitting normalization and gamma, as well as the respective
-    R^2 for this fit, for each pixel.
+    R^2 for this fit, for each pixel. These are NaN for pixels where the fit
+    did not converge.
+
+    The pixels are fitted together in blocks of `block_size` pixels (see
+    `general.curve_fit_batched`).
     """
     normalizations = np.full(jmeans.shape[1:], np.nan)
     gammas = normalizations.copy()
     Rsquares = normalizations.copy()
-    try:
-        for i in range(jmeans.shape[1]):
-            for j in range(jmeans.shape[2]):
-                for k in range(jmeans.shape[3]):
-                    popt, pcov = curve_fit(sRGB, intensities, jmeans[:,i,j,k], p0=[1, 2.2])
-                    normalizations[i,j,k], gammas[i,j,k] = popt
-                    jmeans_fit = sRGB(intensities, *popt)
-                    Rsquares[i,j,k] = Rsquare(jmeans[:,i,j,k], jmeans_fit)
-            if i%10 == 0:
-                print(100*i/jmeans.shape[1])
-    except BaseException as e:  # BaseException so we also catch SystemExit and KeyboardInterrupt
-        print(e)
-        pass
-    finally:
-        return normalizations, gammas, Rsquares
-
-
-def sRGB_compare_gamma(intensities, jmeans, gamma):
+
+    # One column per pixel, with the intensities broadcast against them
+    jmeans_flat = jmeans.reshape((len(jmeans), -1))
+    intensities = np.asarray(intensities)[:, np.newaxis]
+
+    for start in range(0, jmeans_flat.shape[1], block_size):
+        block = np.s_[start:start+block_size]
+        jmeans_block = np.asarray(jmeans_flat[:, block], dtype=np.float64)
+
+        popt, converged = curve_fit_batched(sRGB, sRGB_jacobian, intensities, jmeans_block, p0=[1, 2.2])
+        jmeans_fit = sRGB(intensities, *popt)
+        R2 = np.ma.filled(Rsquare(jmeans_block, jmeans_fit, axis=0), np.nan)
+
+        normalizations.reshape(-1)[block] = np.where(converged, popt[0], np.nan)
+        gammas.reshape(-1)[block] = np.where(converged, popt[1], np.nan)
+        Rsquares.reshape(-1)[block] = np.where(converged, R2, np.nan)
+        print(f"{100*min(start+block_size, jmeans_flat.shape[1])/jmeans_flat.shape[1]:.1f}%", end=" ", flush=True)
+    print()
+
+    return normalizations, gammas, Rsquares
+
+
+def sRGB_compare_gamma(intensities, jmeans, gamma, block_size=2**16):
     """
     Fit sRGB profiles with a given `gamma` and free normalization to given
     `intensities` and responsese `jmeans`. Calculate the RMS difference between
     the best-fitting model with `gamma` and the data.
+
+    The pixels are fitted together in blocks of `block_size` pixels (see
+    `general.curve_fit_batched`). The results are NaN for pixels where the fit
+    did not converge.
     """
     normalizations = np.full(jmeans.shape[1:], np.nan)
     Rsquares = normalizations.copy()
     RMSes = normalizations.copy()
     RMSes_relative = normalizations.copy()
-    sRGB = lambda I, normalization: sRGB(I, normalization, gamma=gamma)
-    try:
-        for i in range(jmeans.shape[1]):
-            for j in range(jmeans.shape[2]):
-                for k in range(jmeans.shape[3]):
-                    popt, pcov = curve_fit(sRGB, intensities, jmeans[:,i,j,k], p0=[1])
-                    normalizations[i,j,k] = popt[0]
-                    ind = np.where(jmeans[:,i,j,k] < 255)
-                    jmeans_fit = sRGB(intensities[ind], *popt)
-                    Rsquares[i,j,k] = Rsquare(jmeans[:,i,j,k][ind], jmeans_fit)
-                    RMSes[i,j,k] = RMS(jmeans[:,i,j,k][ind] - jmeans_fit)
-                    RMSes_relative[i,j,k] = RMS(1 - jmeans[:,i,j,k][ind] / jmeans_fit)
-            if i%30 == 0:
-                print(100*i/jmeans.shape[1])
-    except BaseException:  # BaseException so we also catch SystemExit and KeyboardInterrupt
-        pass
-    finally:
-        return normalizations, Rsquares, RMSes, RMSes_relative
+
+    # sRGB model with a fixed gamma, and its derivative to the normalization
+    sRGB_fixed = lambda I, normalization: sRGB(I, normalization, gamma=gamma)
+    sRGB_fixed_jacobian = lambda I, normalization: sRGB_jacobian(I, normalization, gamma=gamma)[:1]
+
+    # One column per pixel, with the intensities broadcast against them
+    jmeans_flat = jmeans.reshape((len(jmeans), -1))
+    intensities = np.asarray(intensities)[:, np.newaxis]
+
+    for start in range(0, jmeans_flat.shape[1], block_size):
+        block = np.s_[start:start+block_size]
+        jmeans_block = np.asarray(jmeans_flat[:, block], dtype=np.float64)
+
+        popt, converged = curve_fit_batched(sRGB_fixed, sRGB_fixed_jacobian, intensities, jmeans_block, p0=[1])
+        jmeans_fit = sRGB_fixed(intensities, *popt)
+
+        # Compare the model to the non-saturated data only
+        jmeans_unsaturated = np.ma.masked_array(jmeans_block, mask=(jmeans_block >= 255))
+        results = [Rsquare(jmeans_unsaturated, jmeans_fit, axis=0), RMS(jmeans_unsaturated - jmeans_fit, axis=0), RMS(1 - jmeans_unsaturated / jmeans_fit, axis=0)]
+
+        normalizations.reshape(-1)[block] = np.where(converged, popt[0], np.nan)
+        for result_map, result in zip([Rsquares, RMSes, RMSes_relative], results):
+            result_map.reshape(-1)[block] = np.where(converged, np.ma.filled(result, np.nan), np.nan)
+        print(f"{100*min(start+block_size, jmeans_flat.shape[1])/jmeans_flat.shape[1]:.1f}%", end=" ", flush=True)
+    print()
+
+    return normalizations, Rsquares, RMSes, RMSes_relative
 
 
 def pearson_r_single(x, y, saturate):
@@ -146,45 +187,104 @@ def pearson_r_single(x, y, saturate):
     Calculate the Pearson r correlation between `x` and `y`, ignoring data
     above the saturation limit `saturate`.
     """
+    from scipy.stats import pearsonr  # Slow to import, so only done when used
     ind = np.where(y < saturate)
     r, p = pearsonr(x[ind], y[ind])
     return r
 
 
-def calculate_pearson_r_values(x, y, **kwargs):
+def _pearson_r_block(x, y, saturate):
+    """
+    Calculate the Pearson r correlation between `x` and each series along the
+    first axis of `y`, ignoring data above the saturation limit `saturate`.
+
+    Returns the r values and a boolean array that is True where fewer than
+    two data points are not saturated (r is NaN there).
+    """
+    # Use only the non-saturated data, with `x` broadcast against `y`
+    x = np.reshape(x, (-1,) + (1,) * (y.ndim - 1))
+    valid = y < saturate
+    y = np.where(valid, y, 0).astype(np.float64)
+    counts = valid.sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Deviations from the mean of the non-saturated data, 0 for saturated data
+        x_mean = (x * valid).sum(axis=0) / counts
+        y_mean = y.sum(axis=0) / counts
+        x_deviation = np.where(valid, x - x_mean, 0)
+        y_deviation = np.where(valid, y - y_mean, 0)
+
+        # Correlation coefficient, limited to [-1, 1] against rounding errors
+        r = (x_deviation * y_deviation).sum(axis=0) / np.sqrt((x_deviation**2).sum(axis=0) * (y_deviation**2).sum(axis=0))
+    r = np.clip(r, -1, 1)
+
+    saturated = counts < 2
+    r[saturated] = np.nan
+    return r, saturated
+
+
+def calculate_pearson_r_values(x, y, saturate, block_size=2**22, workers=1):
     """
-    Apply 'pearson_r_single' for every pixel in `y` (two-dimensional).
+    Calculate the Pearson r correlation between `x` and the data for every
+    pixel in `y` (shape [len(x), ...]), ignoring data above the saturation
+    limit `saturate`. This gives the same result as 'pearson_r_single' for
+    each pixel.
+
+    Returns the r values, and a list of the indices of the pixels with fewer
+    than two non-saturated data points (r is NaN for these).
+
+    The pixels are processed in blocks of rows with about `block_size` data
+    points each, using `workers` threads.
 
     Use this for RAW data.
     """
-    saturated = []
-    r = np.zeros(y.shape[1:])
-    for i in range(y.shape[1]):
-        for j in range(y.shape[2]):
-            try:
-                r[i,j] = pearson_r_single(x, y[:,i,j], **kwargs)
-            except TypeError:  # if fully saturated
-                r[i,j] = np.nan
-                saturated.append((i,j))
-        if i%5 == 0:
-            print(f"{i/y.shape[1]*100:.1f}%", end=" ", flush=True)
+    r = np.empty(y.shape[1:])
+    saturated = np.empty(y.shape[1:], dtype=bool)
+
+    # Split the rows into blocks; each row has y.size // y.shape[1] data points, including any colour channels
+    rows_per_block = max(block_size // max(y.size // max(y.shape[1], 1), 1), 1)
+    starts = range(0, y.shape[1], rows_per_block)
+
+    def process_block(start):
+        block = np.s_[start:start+rows_per_block]
+        r[block], saturated[block] = _pearson_r_block(x, y[:, block], saturate)
+        return start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in executor.map(process_block, starts):
+            print(f"{start/y.shape[1]*100:.1f}%", end=" ", flush=True)
+    print()
 
+    saturated = [tuple(index) for index in np.argwhere(saturated).tolist()]
     return r, saturated
 
 
-def calculate_pearson_r_values_jpeg(x, y, **kwargs):
+def calculate_pearson_r_values_jpeg(x, y, saturate=240, **kwargs):
     """
-    Apply 'pearson_r_single' for every pixel in `y` (three-dimensional).
+    Calculate the Pearson r correlation between `x` and the data for every
+    pixel in `y` (shape [len(x), ..., 3]), as in
+    `calculate_pearson_r_values`, for each of the three colour channels.
 
     Use this for JPEG data.
     """
-    r, saturated = [[], [], []], [[], [], []]
-    for j in range(3):
-        r[j], saturated[j] = calculate_pearson_r_values(x, y[..., j], saturate=240)
-    r = np.stack(r)
+    r, saturated = calculate_pearson_r_values(x, y, saturate=saturate, **kwargs)
+
+    # Split the results per colour channel
+    r = np.moveaxis(r, -1, 0)
+    saturated = [[index[:-1] for index in saturated if index[-1] == j] for j in range(3)]
     return r, saturated
 
 
+@lru_cache(maxsize=None)
+def load_default_angle(folder):
+    """
+    Load the default polariser angle from `folder`/default_angle.dat.
+    The result is cached, so the file is only read once per folder.
+    """
+    offset_angle = np.loadtxt(folder/"default_angle.dat").ravel()[0]
+    return offset_angle
+
+
 def filename_to_intensity(filename):
     """
     Split filenames according to one of the standards (see below) and convert
@@ -196,7 +296,7 @@ def filename_to_intensity(filename):
     """
     if "pol" in filename.stem:
         angle = io.split_pol_angle(filename)
-        offset_angle = np.loadtxt(filename.parent/"default_angle.dat").ravel()[0]
+        offset_angle = load_default_angle(filename.parent)
         intensity = malus(angle, offset_angle)
         intensity_error = malus_error(angle, offset_angle, sigma_angle0=1, sigma_angle1=1)
     elif "t" in filename.stem:
@@ -1,6 +1,109 @@
 import numpy as np
 
 
+class BayerPattern(object):
+    """
+    Object that represents the Bayer pattern of a sensor (or part of it),
+    storing only the 2x2 pattern of RGBG2 channels and the shape, and
+    providing functions for accessing the channels with slices.
+
+    A full Bayer map (RGBG2 channel for each pixel) is only generated when it
+    is needed, for example by `np.asarray`.
+    """
+    def __init__(self, pattern, shape):
+        """
+        Generate a BayerPattern object from a 2x2 `pattern` of RGBG2 channel
+        indices (starting at the top left pixel) and the `shape` of the data.
+        """
+        self.pattern = np.array(pattern, dtype=np.uint8).reshape((2, 2))
+        self.shape = tuple(int(length) for length in shape)
+        self._map = None
+
+    @classmethod
+    def from_map(cls, bayer_map):
+        """
+        Generate a BayerPattern object from a full Bayer map.
+        """
+        bayer_map = np.asarray(bayer_map)
+        return cls(bayer_map[:2, :2], bayer_map.shape)
+
+    def __repr__(self):
+        """
+        Text representation of the BayerPattern object
+        """
+        return f"Bayer pattern {self.pattern.tolist()} for data of shape {self.shape}"
+
+    def channel_slices(self, colours=range(4)):
+        """
+        Generate the slices that select each of the `colours` from data with
+        this Bayer pattern, along their last two axes.
+        """
+        return _generate_bayer_slices(self.pattern, colours)
+
+    def tiles(self):
+        """
+        Get a read-only view of the Bayer map with shape [y/2, 2, x/2, 2],
+        repeating the 2x2 pattern without using any memory.
+        """
+        tile_shape = (-(-self.shape[0] // 2), 2, -(-self.shape[1] // 2), 2)
+        return np.broadcast_to(self.pattern[np.newaxis, :, np.newaxis, :], tile_shape)
+
+    @property
+    def map(self):
+        """
+        The full Bayer map, with the Bayer channel (RGBG2) for each pixel. This
+        is generated when first used and is read-only.
+        """
+        if self._map is None:
+            tiles = self.tiles()
+            bayer_map = tiles.reshape((2*tiles.shape[0], 2*tiles.shape[2]))[:self.shape[0], :self.shape[1]]
+            bayer_map.flags.writeable = False
+            self._map = bayer_map
+        return self._map
+
+    def __array__(self, dtype=None):
+        """
+        Convert to a full Bayer map, e.g. with `np.asarray`.
+        """
+        return self.map if dtype is None else self.map.astype(dtype)
+
+    def __getitem__(self, selection):
+        """
+        Select part of the data. For slices with odd (e.g. unit) steps, this
+        gives the BayerPattern for that part of the data; otherwise, it gives
+        the relevant part of the full Bayer map.
+        """
+        selection_tuple = selection if isinstance(selection, tuple) else (selection,)
+
+        # Only the last two axes are relevant, so remove leading ellipses
+        if len(selection_tuple) > 0 and selection_tuple[0] is Ellipsis:
+            selection_tuple = selection_tuple[1:]
+        selection_tuple = selection_tuple + (slice(None),) * (2 - len(selection_tuple))
+
+        # Anything other than slices with odd steps does not give a Bayer pattern
+        if len(selection_tuple) != 2 or not all(isinstance(s, slice) for s in selection_tuple):
+            return self.map[selection]
+        ranges = [range(*s.indices(length)) for s, length in zip(selection_tuple, self.shape)]
+        if any(r.step % 2 == 0 for r in ranges):
+            return self.map[selection]
+
+        # Shift the pattern to the new starting pixel
+        rows, columns = [(r.start + np.arange(2) * r.step) % 2 for r in ranges]
+        pattern = self.pattern[rows][:, columns]
+        shape = [len(r) for r in ranges]
+        return self.__class__(pattern, shape)
+
+
+def as_bayer_pattern(bayer_map):
+    """
+    Convert a full Bayer map to a BayerPattern object, if it is not one
+    already.
+    """
+    if isinstance(bayer_map, BayerPattern):
+        return bayer_map
+    return BayerPattern.from_map(bayer_map)
+
+
 def _generate_bayer_slices(color_pattern, colours=range(4)):
     """
     Generate the slices used to demosaick data.
@@ -14,37 +117,67 @@ def _generate_bayer_slices(color_pattern, colours=range(4)):
     return slices
 
 
-def demosaick(bayer_map, data, color_desc="RGBG"):
+def _is_same(dtype):
+    """
+    Check if `dtype` is "same", meaning that the data type of the input data
+    should be kept.
+    """
+    return isinstance(dtype, str) and dtype == "same"
+
+
+def demosaick(bayer_map, data, color_desc="RGBG", copy=True, dtype=np.float64):
     """
-    Uses a Bayer map `bayer_map` (RGBG channel for each pixel) and any number
-    of input arrays `data`.
+    Uses a Bayer map `bayer_map` (RGBG channel for each pixel, or a
+    BayerPattern object) and any number of input arrays `data`.
+
+    By default, returns a new array of shape [..., 4, x/2, y/2] with data type
+    `dtype` (default: float64). Use `dtype="same"` to keep the data type of
+    `data`, which saves memory for e.g. float32 data. If `copy` is False,
+    returns a list of the four RGBG2 channels as strided views of `data`
+    instead, so no data are copied.
     """
     # Cast the data to a numpy array for the following indexing tricks to work
-    data = np.array(data)
+    data = np.asanyarray(data)
 
     # Check that we are dealing with RGBG2 data, as only these are supported right now.
     assert color_desc in ("RGBG", b"RGBG"), f"Unknown colour description `{color_desc}"
 
     # Check that the data and Bayer pattern have similar shapes
-    assert data.shape[-2:] == bayer_map.shape, f"The data ({data.shape}) and Bayer map ({bayer_map.shape}) have incompatible shapes"
+    assert data.shape[-2:] == tuple(bayer_map.shape), f"The data ({data.shape}) and Bayer map ({bayer_map.shape}) have incompatible shapes"
 
-    # Demosaick the data along their last two axes
-    bayer_pattern = bayer_map[:2, :2]
-    slices = _generate_bayer_slices(bayer_pattern)
+    # Demosaick the data along their last two axes, as views
+    slices = as_bayer_pattern(bayer_map).channel_slices()
+    channels = [data[s] for s in slices]
+    if not copy:
+        return channels
 
     # Combine the data back into one array of shape [..., 4, x/2, y/2]
     newshape = list(data.shape[:-2]) + [4, data.shape[-2]//2, data.shape[-1]//2]
-    RGBG = np.empty(newshape)
-    for i, s in enumerate(slices):
-        RGBG[..., i, :, :] = data[s]
+    RGBG = np.empty(newshape, dtype=data.dtype if _is_same(dtype) else dtype)
+    for i, channel in enumerate(channels):
+        RGBG[..., i, :, :] = channel
 
     return RGBG
 
 
-def put_together_from_colours(RGBG, colours):
-    original = np.zeros((2*RGBG.shape[1], 2*RGBG.shape[2]))
-    for j in range(4):
-        original[np.where(colours == j)] = RGBG[j].ravel()
+def put_together_from_colours(RGBG, colours, dtype=np.float64):
+    """
+    Re-mosaick RGBG2 data `RGBG`, an array of shape [..., 4, x/2, y/2] or a
+    list of the four channels, into a single array of shape [..., x, y],
+    using a Bayer map `colours` (RGBG channel for each pixel, or a
+    BayerPattern object).
+
+    The result has data type `dtype` (default: float64). Use `dtype="same"`
+    to keep the data type of `RGBG`.
+    """
+    bayer = as_bayer_pattern(colours)
+    if isinstance(RGBG, np.ndarray):
+        RGBG = [RGBG[..., j, :, :] for j in range(4)]
+
+    # Assign each channel to its pixels with strided slices
+    original = np.empty(RGBG[0].shape[:-2] + bayer.shape, dtype=np.result_type(*RGBG) if _is_same(dtype) else dtype)
+    for channel, s in zip(RGBG, bayer.channel_slices()):
+        original[s] = channel
     return original
 
 
@@ -65,7 +198,12 @@ def to_RGB_array(raw_image, color_pattern):
 
 
 def multiply_RGBG(data, colours, factors):
+    """
+    Multiply each RGBG2 channel of `data` by the corresponding element of
+    `factors`, using a Bayer map `colours` (RGBG channel for each pixel, or a
+    BayerPattern object).
+    """
     data_new = data.copy()
-    for j in range(4):
-        data_new[colours == j] *= factors[j]
+    for factor, s in zip(factors, as_bayer_pattern(colours).channel_slices()):
+        data_new[s] *= factor
     return data_new
@@ -0,0 +1,166 @@
+"""
+Code relating to the decoded RAW cache, which stores the decoded image data
+of RAW files on disk as uncompressed .npy files. Repeated analyses of the
+same files then read these with memory-mapping instead of decoding the RAW
+files again.
+
+Cache entries are keyed on the absolute path, modification time, and size of
+a RAW file (default), or on a hash of its contents. When the cache is larger
+than its size limit, the least recently used entries are removed.
+
+The cache is opt-in, see `io.enable_raw_cache`.
+"""
+
+import numpy as np
+import hashlib
+import shutil
+import os
+from pathlib import Path
+from threading import Lock, get_ident
+
+# Arrays stored for each RAW file
+cached_arrays = ["raw_image", "raw_colors", "black_level_per_channel"]
+
+
+def _stat_key(filename):
+    """
+    Generate a cache key from the absolute path, modification time, and size
+    of a file `filename`.
+    """
+    path = Path(filename).absolute()
+    stat = path.stat()
+    text = f"{path}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _content_key(filename, blocksize=2**20):
+    """
+    Generate a cache key from the contents of a file `filename`.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(blocksize), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+_key_functions = {"stat": _stat_key, "content": _content_key}
+
+
+def _folder_size(folder):
+    """
+    Calculate the total size of the files in `folder`.
+    """
+    return sum(file.stat().st_size for file in folder.iterdir())
+
+
+class RawCache(object):
+    """
+    Object that represents a decoded RAW cache in a given folder, providing
+    functions for loading RAW data through it.
+    """
+    def __init__(self, folder, max_size=10e9, key="stat"):
+        """
+        Open (or create) a decoded RAW cache in `folder`, with a size limit
+        of `max_size` bytes. `key` determines how files are identified: "stat"
+        (path, modification time, and size) or "content" (hash of the file).
+        """
+        self.folder = Path(folder)
+        self.max_size = max_size
+        self.key = key
+        self._key_function = _key_functions[key]
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    def __repr__(self):
+        """
+        Text representation of the RawCache object
+        """
+        return f"Decoded RAW cache in `{self.folder}` (limit: {self.max_size/1e9:.1f} GB; hits: {self.hits}, misses: {self.misses})"
+
+    def _entries(self):
+        """
+        List all entries in the cache.
+        """
+        return [entry for entry in self.folder.iterdir() if entry.is_dir() and not entry.name.startswith(".")]
+
+    def size(self):
+        """
+        Calculate the total size of the cache on disk, in bytes.
+        """
+        return sum(_folder_size(entry) for entry in self._entries())
+
+    def clear(self):
+        """
+        Remove all entries from the cache, as well as any temporary folders
+        left behind by processes that were stopped while storing an entry.
+        """
+        with self._lock:
+            temporary = [folder for folder in self.folder.glob(".*.tmp") if folder.is_dir()]
+            for entry in self._entries() + temporary:
+                shutil.rmtree(entry, ignore_errors=True)
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is within its
+        size limit. The entry `keep` is never removed.
+        """
+        entries = [(entry.stat().st_mtime, _folder_size(entry), entry) for entry in self._entries() if entry != keep]
+        total_size = sum(size for _, size, _ in entries) + (0 if keep is None else _folder_size(keep))
+        for _, size, entry in sorted(entries, key=lambda item: item[0]):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+    def _store(self, filename, entry):
+        """
+        Decode the RAW file `filename` and store its arrays in the cache entry
+        `entry`. The arrays are written to a temporary folder first, so other
+        threads or processes never see an incomplete entry.
+        """
+        import rawpy  # Slow to import, so only done when used
+        temporary = self.folder/f".{entry.name}.{os.getpid()}.{get_ident()}.tmp"
+        os.makedirs(temporary, exist_ok=True)
+
+        # Remove the temporary folder if decoding fails (e.g. for a corrupt file) or is interrupted
+        try:
+            with rawpy.imread(str(filename)) as img:
+                for name in cached_arrays:
+                    np.save(temporary/f"{name}.npy", np.asarray(getattr(img, name)))
+        except BaseException:
+            shutil.rmtree(temporary, ignore_errors=True)
+            raise
+
+        try:
+            os.replace(temporary, entry)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    def load(self, filename):
+        """
+        Load the arrays in `cached_arrays` for the RAW file `filename`, as a
+        dictionary. If the file is in the cache, the arrays are memory-mapped
+        (read-only); otherwise, the file is decoded and added to the cache
+        first.
+        """
+        entry = self.folder/self._key_function(filename)
+
+        if entry.exists():
+            # Mark this entry as recently used
+            os.utime(entry)
+            with self._lock:
+                self.hits += 1
+        else:
+            # Decode outside the lock, so multiple files can be decoded in parallel
+            self._store(filename, entry)
+            with self._lock:
+                self.misses += 1
+                self._evict(keep=entry)
+
+        arrays = {name: np.load(entry/f"{name}.npy", mmap_mode="r") for name in cached_arrays}
+        return arrays
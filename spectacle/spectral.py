@@ -1,7 +1,6 @@
 import numpy as np
-from matplotlib import pyplot as plt
 
-from . import io, plot
+from . import io
 from .general import return_with_filename
 from ._xyz import wavelengths as cie_wavelengths, xyz as cie_xyz
 from ._spectral_convolution import convolve, convolve_multi
@@ -109,6 +108,9 @@ def plot_monochromator_curves(wavelengths, mean, variance, wavelength_min=390, w
     Plot spectral response curves as measured by monochromator.
     Plots three panels, namely mean response, variance, and signal-to-noise ratio.
     """
+    from matplotlib import pyplot as plt
+    from . import plot
+
     # Labels for the plots
     labels = [f"Response\n[{unit}]", f"Variance\n[{unit}$^2$]", "SNR"]
 
@@ -155,6 +157,9 @@ def plot_spectral_responses(wavelengths, SRFs, labels, linestyles=["-", "--", ":
     """
     Plot spectral responses (`SRFs`) together in one panel.
     """
+    from matplotlib import pyplot as plt
+    from . import plot
+
     # Create a figure to hold the plot
     plt.figure(figsize=(7,3), tight_layout=True)
 
@@ -421,6 +426,9 @@ def plot_xy_on_gamut(xy_base_vectors, label="", saveto=None):
     Plot the xy base vectors of any number of colour spaces on the xy plane.
     If possible, use colorio's function to plot the human eye and sRGB gamuts.
     """
+    from matplotlib import pyplot as plt
+    from . import plot
+
     saveto = plot._convert_to_path(saveto)
 
     try:
@@ -483,6 +491,9 @@ def plot_xyz_and_rgb(RGB_wavelengths, RGB_responses, label="", saveto=None):
     """
     Plot the xyz colour matching functions and given RGB responses.
     """
+    from matplotlib import pyplot as plt
+    from . import plot
+
     # Check if a single set of wavelengths/responses was given or multiple
     try:  # This throws an error if a single set of wavelengths was given
         _ = len(RGB_wavelengths[0])
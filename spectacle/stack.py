@@ -0,0 +1,531 @@
+"""
+Code relating to stacking image data, such as calculating the mean and
+standard deviation per pixel over a series of images without loading all of
+them into memory at once.
+
+Folders are stacked either by streaming through the images one at a time, or
+(for robust statistics, or data sets that do not fit within a memory limit)
+by writing the decoded images to a temporary file and reducing them in blocks
+of rows. Both are used through `stack_images` and `stack_folder_tree`.
+"""
+
+import numpy as np
+from os import walk, makedirs
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from . import io
+
+# Version of the stacking method, stored in manifests - increase this when
+# changes to the stacking code affect the results, so old stacks are rebuilt.
+# Standard deviations from different versions are not bit-identical; see tools/README.md
+stacking_version = 2
+
+
+class RunningStatistics(object):
+    """
+    Object that keeps track of the per-pixel mean and variance of a series of
+    arrays, which are added one at a time.
+
+    The running sum and sum of squares are stored in float64. For integer
+    image data (RAW or JPEG) these sums are exact, so the resulting statistics
+    do not depend on the order in which arrays are added, and two objects can
+    be merged without any loss of precision.
+    """
+    def __init__(self):
+        """
+        Generate an empty RunningStatistics object.
+        """
+        self.count = 0
+        self.sum = None
+        self.sum_squares = None
+
+    def __repr__(self):
+        """
+        Text representation of the RunningStatistics object
+        """
+        shape = None if self.sum is None else self.sum.shape
+        return f"RunningStatistics (count: {self.count}, shape: {shape})"
+
+    def update(self, data):
+        """
+        Add a single array `data` to the running statistics.
+        """
+        # Convert the data to float64 once, and re-use it for both sums
+        data = np.asarray(data, dtype=np.float64)
+
+        # If this is the first array, use it to initialise the sums
+        if self.sum is None:
+            self.sum = data.copy()
+            self.sum_squares = data**2
+        else:
+            assert data.shape == self.sum.shape, f"The data ({data.shape}) and running statistics ({self.sum.shape}) have incompatible shapes"
+            self.sum += data
+            data **= 2
+            self.sum_squares += data
+
+        self.count += 1
+
+    @classmethod
+    def from_array(cls, data):
+        """
+        Generate a RunningStatistics object for all arrays in `data` along its
+        first axis (e.g. the frames in a block of rows) at once. The sums are
+        the same as when adding the arrays one at a time with `update`.
+        """
+        statistics = cls()
+        data = np.array(data, dtype=np.float64)  # Copy, since it is squared in place
+        statistics.count = len(data)
+        statistics.sum = data.sum(axis=0)
+        data **= 2
+        statistics.sum_squares = data.sum(axis=0)
+        return statistics
+
+    def merge(self, other):
+        """
+        Merge the statistics from another RunningStatistics object `other` into
+        this one, for example when parts of a series were stacked separately.
+        """
+        # Nothing to merge if the other object is empty
+        if other.count == 0:
+            return
+
+        # If this object is empty, simply copy the other one
+        if self.count == 0:
+            self.sum = other.sum.copy()
+            self.sum_squares = other.sum_squares.copy()
+        else:
+            assert other.sum.shape == self.sum.shape, f"The running statistics have incompatible shapes ({other.sum.shape} and {self.sum.shape})"
+            self.sum += other.sum
+            self.sum_squares += other.sum_squares
+
+        self.count += other.count
+
+    def mean(self, dtype=np.float32):
+        """
+        Calculate the mean per pixel, cast to `dtype`.
+        """
+        assert self.count > 0, "Cannot calculate statistics without any data"
+        mean = self.sum / self.count
+        return mean.astype(dtype)
+
+    def variance(self, dtype=np.float32):
+        """
+        Calculate the (population) variance per pixel, cast to `dtype`.
+        This uses the same normalisation as `numpy.var` with its default `ddof=0`.
+        """
+        assert self.count > 0, "Cannot calculate statistics without any data"
+        # (N * sum(x^2) - sum(x)^2) / N^2 - the numerator is exact for integer data
+        variance = self.sum_squares * self.count
+        variance -= self.sum**2
+        variance /= self.count**2
+
+        # Remove negative values caused by floating-point rounding
+        np.clip(variance, 0, None, out=variance)
+        return variance.astype(dtype)
+
+    def std(self, dtype=np.float32):
+        """
+        Calculate the (population) standard deviation per pixel, cast to `dtype`.
+        """
+        stds = np.sqrt(self.variance(dtype=np.float64))
+        return stds.astype(dtype)
+
+
+def stack_files(files, load_func=io.load_raw_image, dtype=np.float32):
+    """
+    Calculate the mean and standard deviation per pixel of the image data in
+    `files`, loaded with `load_func` one file at a time. The results are cast
+    to `dtype` (default: float32, like the stacks saved by `stack_mean_std.py`).
+
+    Only one file is in memory at any time, so the memory use does not depend
+    on the number of files.
+    """
+    assert len(files) > 0, "No files were given to stack"
+
+    statistics = RunningStatistics()
+    for file in files:
+        statistics.update(load_func(file))
+
+    mean = statistics.mean(dtype=dtype)
+    stds = statistics.std(dtype=dtype)
+    return mean, stds
+
+
+def stack_folder(folder, pattern="*.dng", load_func=io.load_raw_image, **kwargs):
+    """
+    Calculate the mean and standard deviation per pixel of the image data in
+    all files in `folder` matching the pattern `pattern`.
+    Any additional **kwargs are passed to `stack_files`.
+    """
+    files = sorted(Path(folder).glob(pattern))
+    return stack_files(files, load_func=load_func, **kwargs)
+
+
+def stack_folder_raw(folder, pattern="*.dng", **kwargs):
+    """
+    Stack all RAW files in `folder` matching the pattern `pattern`.
+    Any additional **kwargs are passed to `stack_files`.
+    """
+    return stack_folder(folder, pattern=pattern, load_func=io.load_raw_image, **kwargs)
+
+
+def stack_folder_jpg(folder, pattern="*.jp*g", **kwargs):
+    """
+    Stack all JPEG files in `folder` matching the pattern `pattern`.
+    Any additional **kwargs are passed to `stack_files`.
+    """
+    return stack_folder(folder, pattern=pattern, load_func=io.load_jpg_image, **kwargs)
+
+
+def save_stack(goal, mean, stds, prefix=""):
+    """
+    Save a mean and standard deviation stack to `goal`_mean.npy and
+    `goal`_stds.npy, respectively. A `prefix` can be added to the suffixes,
+    e.g. "j" for `goal`_jmean.npy and `goal`_jstds.npy.
+    """
+    np.save(f"{goal}_{prefix}mean.npy", mean)
+    np.save(f"{goal}_{prefix}stds.npy", stds)
+
+
+def write_frames_to_disk(files, filename, load_func=io.load_raw_image, data0=None):
+    """
+    Load the image data in `files` one at a time using `load_func` and write
+    them to a single memory-mapped array of shape (N, ...) at `filename`.
+    This way, every file is only decoded once, while later steps can read any
+    region of all frames without keeping them in memory.
+
+    If the data from the first file were already loaded, they can be passed as
+    `data0` so they are not loaded again.
+    """
+    assert len(files) > 0, "No files were given to stack"
+
+    # Load the first file to get the shape and data type of the images
+    if data0 is None:
+        data0 = load_func(files[0])
+    data0 = np.asarray(data0)
+    frames = np.lib.format.open_memmap(filename, mode="w+", dtype=data0.dtype, shape=(len(files), *data0.shape))
+    frames[0] = data0
+    del data0
+
+    # Include the image data from the other files
+    for j, file in enumerate(files[1:], 1):
+        frames[j] = load_func(file)
+
+    frames.flush()
+    return frames
+
+
+def sigma_clip(data, sigma=3., max_iterations=5):
+    """
+    Iteratively remove outliers from `data` along its first axis (e.g. the
+    frames in a stack). In each iteration, elements further than `sigma`
+    standard deviations from the median are removed, until no more elements
+    are removed or `max_iterations` is reached.
+
+    Returns the data as floating-point numbers with the removed elements
+    replaced by NaN.
+    """
+    clipped = data.astype(np.float32)
+    for i in range(max_iterations):
+        median = np.nanmedian(clipped, axis=0)
+        std = np.nanstd(clipped, axis=0)
+
+        # Find elements that are too far from the median
+        with np.errstate(invalid="ignore"):
+            outliers = np.abs(clipped - median) > sigma * std
+
+        # Stop if no new elements were removed
+        if not outliers.any():
+            break
+        clipped[outliers] = np.nan
+
+    return clipped
+
+
+def _reduce_mean(block, **kwargs):
+    """
+    Calculate the mean and standard deviation of a block of data along its
+    first axis, using the same float64 sums as streaming through the files
+    (see `RunningStatistics`), so the results do not depend on the method.
+    """
+    statistics = RunningStatistics.from_array(block)
+    return {"mean": statistics.mean(), "stds": statistics.std()}
+
+
+def _reduce_median(block, **kwargs):
+    """
+    Calculate the median of a block of data along its first axis.
+    """
+    return {"median": np.median(block, axis=0)}
+
+
+def _reduce_sigma_clip(block, **kwargs):
+    """
+    Calculate the sigma-clipped mean and standard deviation of a block of data
+    along its first axis, as well as the number of elements that were removed.
+    Any additional **kwargs are passed to `sigma_clip`.
+    """
+    clipped = sigma_clip(block, **kwargs)
+    rejected = np.isnan(clipped).sum(axis=0)
+    return {"mean": np.nanmean(clipped, axis=0), "stds": np.nanstd(clipped, axis=0), "rejected": rejected}
+
+
+# Stacking methods that work on blocks of rows, and the data types of their outputs
+tiled_methods = {"mean": (_reduce_mean, {"mean": np.float32, "stds": np.float32}),
+                 "median": (_reduce_median, {"median": np.float32}),
+                 "sigma_clip": (_reduce_sigma_clip, {"mean": np.float32, "stds": np.float32, "rejected": np.uint16})}
+
+# Approximate working memory, in bytes per element of a block of rows (tiled
+# methods) or per pixel of a frame (streaming with RunningStatistics)
+_tiled_bytes_per_element = 16
+_streaming_bytes_per_pixel = 24
+
+
+def tile_rows_for_memory(nr_frames, frame_shape, memory_limit):
+    """
+    Find the number of rows of `nr_frames` frames of shape `frame_shape` that
+    can be reduced at once within `memory_limit` bytes (at least 1).
+    """
+    bytes_per_row = nr_frames * np.prod(frame_shape[1:], dtype=int) * _tiled_bytes_per_element
+    tile_rows = max(1, int(memory_limit // bytes_per_row))
+    return tile_rows
+
+
+def stack_files_tiled(files, method="mean", load_func=io.load_raw_image, tile_rows=None, memory_limit=1e9, temporary_folder=None, data0=None, **kwargs):
+    """
+    Calculate statistics per pixel of the image data in `files`, loaded with
+    `load_func`. Supported methods are "mean" (mean and standard deviation),
+    "median", and "sigma_clip" (sigma-clipped mean and standard deviation, as
+    well as the number of frames rejected in each pixel). Any additional
+    **kwargs are passed to `sigma_clip`.
+
+    Every file is decoded once and written to a temporary file (in
+    `temporary_folder`, default: the system default). The statistics are then
+    calculated in blocks of `tile_rows` rows. If `tile_rows` is not given, it
+    is chosen so the blocks fit within `memory_limit` bytes.
+
+    Returns a dictionary with the outputs of the given method.
+    """
+    reduce_func, output_dtypes = tiled_methods[method]
+
+    with TemporaryDirectory(dir=temporary_folder) as folder:
+        frames = write_frames_to_disk(files, Path(folder)/"frames.npy", load_func=load_func, data0=data0)
+        results = {name: np.empty(frames.shape[1:], dtype=dtype) for name, dtype in output_dtypes.items()}
+
+        # Determine the block size
+        if tile_rows is None:
+            tile_rows = tile_rows_for_memory(len(files), frames.shape[1:], memory_limit)
+
+        # Reduce the data one block of rows at a time
+        for start in range(0, frames.shape[1], tile_rows):
+            block = np.array(frames[:, start:start+tile_rows])
+            for name, result in reduce_func(block, **kwargs).items():
+                results[name][start:start+tile_rows] = result
+
+        del frames
+
+    return results
+
+
+def stack_images(files, method="mean", load_func=io.load_raw_image, memory_limit=None, **kwargs):
+    """
+    Calculate statistics per pixel of the image data in `files`, loaded with
+    `load_func`, using the given `method` (see `stack_files_tiled`).
+
+    The mean and standard deviation are calculated by streaming through the
+    files (see `stack_files`) if this fits within `memory_limit` bytes (or if
+    no limit is given). Otherwise, and for the other methods, the statistics
+    are calculated in blocks of rows that fit within `memory_limit` (see
+    `stack_files_tiled`). Any additional **kwargs are passed to
+    `stack_files_tiled`.
+
+    Returns a dictionary with the outputs of the given method.
+    """
+    files = sorted(files)
+    assert method in tiled_methods, f"Unknown stacking method `{method}`; must be one of {list(tiled_methods)}"
+
+    # Without a memory limit, use the streaming mean or the default tiled memory limit
+    if memory_limit is None:
+        if method == "mean":
+            mean, stds = stack_files(files, load_func=load_func)
+            return {"mean": mean, "stds": stds}
+        return stack_files_tiled(files, method=method, load_func=load_func, **kwargs)
+
+    # Load the first file to determine the frame size
+    data0 = np.asarray(load_func(files[0]))
+
+    # Stream through the files if this fits in memory
+    if method == "mean" and data0.size * _streaming_bytes_per_pixel <= memory_limit:
+        statistics = RunningStatistics()
+        statistics.update(data0)
+        del data0
+        for file in files[1:]:
+            statistics.update(load_func(file))
+        return {"mean": statistics.mean(), "stds": statistics.std()}
+
+    return stack_files_tiled(files, method=method, load_func=load_func, memory_limit=memory_limit, data0=data0, **kwargs)
+
+
+def save_outputs(goal, outputs, prefix=""):
+    """
+    Save each array in a dictionary `outputs` to `goal`_`name`.npy, where
+    `name` is its key, e.g. `goal`_median.npy. A `prefix` can be added to the
+    suffixes, e.g. "j" for `goal`_jmedian.npy.
+    """
+    for name, data in outputs.items():
+        np.save(f"{goal}_{prefix}{name}.npy", data)
+
+
+def manifest_filename(goal):
+    """
+    Filename of the manifest for the stacks saved to `goal`.
+    """
+    return Path(f"{goal}_manifest.json")
+
+
+def create_manifest(files, outputs, **parameters):
+    """
+    Create a manifest describing a stack: the name, size, and modification
+    time of each input file in `files`, the output files `outputs`, and the
+    stacking parameters given as **kwargs.
+    """
+    file_list = []
+    for file in sorted(files):
+        stat = Path(file).stat()
+        file_list.append({"name": Path(file).name, "size": stat.st_size, "mtime": stat.st_mtime})
+
+    manifest = {"files": file_list, "outputs": [str(Path(output).name) for output in outputs], "parameters": {"version": stacking_version, **parameters}}
+    return manifest
+
+
+def manifest_is_current(goal, manifest):
+    """
+    Check if the stacks saved to `goal` are up to date, i.e. if a manifest
+    identical to `manifest` was saved with them and all their output files
+    still exist.
+    """
+    filename = manifest_filename(goal)
+    try:
+        manifest_old = io.load_json(filename)
+    except (FileNotFoundError, ValueError):
+        return False
+
+    outputs_exist = all((filename.parent/output).exists() for output in manifest["outputs"])
+    return outputs_exist and manifest_old == manifest
+
+
+def save_manifest(goal, manifest):
+    """
+    Save a manifest for the stacks saved to `goal`.
+    """
+    io.write_json(manifest, manifest_filename(goal))
+
+
+# Outputs of each stacking method
+method_outputs = {method: list(outputs) for method, (_, outputs) in tiled_methods.items()}
+
+# Common RAW file extensions
+raw_patterns_default = ["*.dng", "*.NEF", "*.CR2"]
+
+
+def stack_folder_tree(folder, raw_patterns=raw_patterns_default, method="mean", memory_limit=None, dry_run=False, force=False):
+    """
+    Walk through `folder` and all its subfolders and stack the RAW (and
+    optionally JPEG) images in each, saving the results to the same path with
+    `images` replaced by `stacks`. For example, images in
+    `level1/images/level3/` are stacked to `level1/stacks/level3_mean.npy` etc.
+
+    The RAW file format is the first of `raw_patterns` that matches any files.
+    `method` and `memory_limit` are passed to `stack_images`.
+
+    A manifest is saved with each stack, and folders whose inputs have not
+    changed since they were last stacked are skipped, unless `force` is True.
+    If `dry_run` is True, the folders that would be stacked are only listed.
+    """
+    raw_pattern = None
+
+    # Walk through the folder and all its subfolders
+    for tup in walk(folder):
+        # The current folder
+        folder_here = Path(tup[0])
+
+        # The folder to save stacks to
+        goal = io.replace_word_in_path(folder_here, "images", "stacks")
+
+        # If the correct RAW file format has not been determined yet, do so
+        if raw_pattern is None:
+            for pattern in raw_patterns:  # Looping over the patterns, look for any files matching it
+                if len(list(folder_here.glob(pattern))) > 0:  # If a match was found, set the raw pattern to match it, and break the loop
+                    raw_pattern = pattern
+                    break
+            else:  # If no match was found at all, continue to the next folder
+                continue
+
+        # Find all RAW files in this folder
+        raw_files = list(folder_here.glob(raw_pattern))
+        if len(raw_files) == 0:
+            # If there are no RAW files in this folder, move on to the next
+            continue
+
+        # Find all JPEG files in this folder
+        JPGs = list(folder_here.glob("*.jp*g"))
+
+        # Describe the inputs and outputs, and skip this folder if its stacks are up to date
+        outputs = [f"{goal}_{name}.npy" for name in method_outputs[method]]
+        if len(JPGs) > 0:
+            outputs += [f"{goal}_j{name}.npy" for name in method_outputs[method]]
+        manifest = create_manifest(raw_files + JPGs, outputs, raw_pattern=raw_pattern, dtype="float32", mode=method)
+        if not force and manifest_is_current(goal, manifest):
+            print(f"{folder_here}  -->  up to date")
+            continue
+
+        # In a dry run, only list the folders that would be stacked
+        if dry_run:
+            print(f"{folder_here}  -->  {goal}_x.npy (dry run: {len(raw_files)} RAW, {len(JPGs)} JPEG)")
+            continue
+
+        # Create the goal folder if it does not exist yet
+        makedirs(goal.parent, exist_ok=True)
+
+        # Stack and save all RAW files, then all JPEG files (if any)
+        for files, load_func, prefix in [(raw_files, io.load_raw_image, ""), (JPGs, io.load_jpg_image, "j")]:
+            if len(files) == 0:
+                continue
+            results = stack_images(files, method=method, load_func=load_func, memory_limit=memory_limit, temporary_folder=goal.parent)
+            save_outputs(goal, results, prefix=prefix)
+
+            # Report how many frames were rejected in sigma-clipping
+            if "rejected" in results:
+                rejected = results["rejected"]
+                print(f"Rejected {rejected.sum()} values in {np.count_nonzero(rejected)} pixels (max. {rejected.max()} frames per pixel)")
+
+        # Print the input and output folder as confirmation
+        print(f"{folder_here}  -->  {goal}_x.npy")
+
+        # Save the manifest last, so interrupted stacks are rebuilt next time
+        save_manifest(goal, manifest)
+
+
+def stack_command_line(argv, **kwargs):
+    """
+    Run `stack_folder_tree` with command-line arguments `argv`: a folder and
+    the options `--dry-run`, `--force`, `--mode=X` (stacking method), and
+    `--memory=X` (memory limit in GB). Any additional **kwargs, such as
+    defaults for these options, are passed to `stack_folder_tree`.
+    """
+    options = [arg for arg in argv[1:] if arg.startswith("--")]
+    folder = io.path_from_input([arg for arg in argv if arg not in options])
+
+    for option in options:
+        if option == "--dry-run":
+            kwargs["dry_run"] = True
+        elif option == "--force":
+            kwargs["force"] = True
+        elif option.startswith("--mode="):
+            kwargs["method"] = option.split("=")[1]
+        elif option.startswith("--memory="):
+            kwargs["memory_limit"] = float(option.split("=")[1]) * 1e9
+        else:
+            raise ValueError(f"Unknown command-line option `{option}`")
+
+    stack_folder_tree(folder, **kwargs)
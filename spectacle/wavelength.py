@@ -1,4 +1,3 @@
-from astropy.stats import sigma_clip
 import numpy as np
 
 """
@@ -25,6 +24,7 @@ def _sigma_clip_indices(x, low=3, high=3, nr_iterations=5):
     return indices
 
 def fit_fluorescent_lines(lines, y):
+    from astropy.stats import sigma_clip
     lines_fit = lines.copy()
     for j in (0,1,2):  # fit separately for R, G, B
         # Filter out non-finite and NaN elements
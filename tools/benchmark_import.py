@@ -0,0 +1,83 @@
+"""
+Measure how long `import spectacle` and the imports of the submodules most
+scripts use (e.g. `from spectacle import io, camera`) take, and check that they
+do not import heavy dependencies (matplotlib, astropy, scipy, rawpy, exifread)
+or create the results folder. These are only imported when they are first
+used. Each import is done in a new Python process, with a temporary home folder.
+NumPy is imported before the timing starts, since every script needs it anyway
+and its import time does not depend on SPECTACLE.
+
+This can be used as a regression check: the script exits with an error if the
+median import time is above the limit, or if any of the checks fail.
+
+Command line arguments:
+    * `--repeat=X` (optional): number of imports to time. Default: 10.
+    * `--limit=X` (optional): maximum median import time per module in ms.
+    Default: 100.
+"""
+
+import numpy as np
+import os
+import subprocess
+import sys
+from sys import argv
+from tempfile import TemporaryDirectory
+
+# Get the options from the command line
+repeat = 10
+limit = 100.
+for option in argv[1:]:
+    if option.startswith("--repeat="):
+        repeat = int(option.split("=")[1])
+    elif option.startswith("--limit="):
+        limit = float(option.split("=")[1])
+
+# Modules that should not be imported until they are used
+heavy_modules = ["matplotlib", "astropy", "scipy", "rawpy", "exifread"]
+
+# Imports to time: the package itself, and the submodules that scripts use
+imports = ["import spectacle", "from spectacle import io", "from spectacle import camera", "from spectacle import io, camera, flat, linearity, stack"]
+
+# Code that is run in each new process: time the import and list any heavy modules that were imported
+code = """
+import sys
+import numpy
+from time import perf_counter
+start = perf_counter()
+{statement}
+end = perf_counter()
+print((end - start) * 1000)
+print(",".join(name for name in {heavy_modules} if name in sys.modules))
+"""
+
+failures = []
+for statement in imports:
+    times = []
+    with TemporaryDirectory() as home:
+        # Use a temporary home folder, to check that no results folder is created
+        environment = dict(os.environ, HOME=home, USERPROFILE=home)
+
+        for j in range(repeat):
+            output = subprocess.run([sys.executable, "-c", code.format(statement=statement, heavy_modules=heavy_modules)], env=environment, capture_output=True, text=True, check=True).stdout.split("\n")
+            times.append(float(output[0]))
+            imported = output[1]
+
+        created_files = os.listdir(home)
+
+    # Print the results
+    median_time = np.median(times)
+    print(f"Import time for `{statement}`: median {median_time:.1f} ms, range {min(times):.1f}-{max(times):.1f} ms ({repeat} imports; limit: {limit:.0f} ms)")
+
+    # Check the results
+    if median_time > limit:
+        failures.append(f"`{statement}`: median import time ({median_time:.1f} ms) is above the limit ({limit:.0f} ms)")
+    if imported:
+        failures.append(f"`{statement}`: heavy modules were imported: {imported}")
+    if created_files:
+        failures.append(f"`{statement}`: files were created in the home folder: {created_files}")
+
+for failure in failures:
+    print(failure)
+if failures:
+    sys.exit(1)
+print("All checks passed")
@@ -0,0 +1,70 @@
+"""
+Calibrate all RAW images in a folder and its subfolders, using the
+calibration data of the camera they were taken with. The ISO speed and
+exposure time of each image are read from its EXIF data. The calibrated data
+are split into RGBG2 channels (optionally converted to XYZ) and saved as NPY
+files, e.g. `level1/images/level3/image1.dng` is saved to
+`level1/calibrated/level3/image1_RGBG2.npy`.
+
+Images are calibrated in parallel by a pool of worker processes, each of
+which loads the camera's calibration data once. Write a calibration bundle
+first (see `calibration/calibration_bundle.py`) so these are memory-mapped and
+shared between the workers. The throughput and the time spent in each stage
+(reading EXIF data, loading, calibrating, demosaicking, converting, saving)
+are reported at the end.
+
+Command line arguments:
+    * `folder`: folder containing RAW images, typically in the `images` folder
+    of a camera's root folder.
+    * `--output=X` (optional): output format, `RGBG2` (default) or `XYZ`.
+    * `--steps=X` (optional): comma-separated calibration steps to apply
+    (default: all; see `Camera.calibrate`), e.g. `--steps=bias,flatfield`.
+    * `--workers=X` (optional): number of worker processes. Default: 4.
+    * `--plan` (optional): use a calibration plan (one affine map pair per
+    ISO speed and exposure time, in float32), which is faster if many images
+    share the same settings.
+
+TO DO:
+    * Allow input/output folders that are not in `images` or `calibrated`
+"""
+
+from sys import argv
+from spectacle import io, batch
+
+# The worker processes import this script on some platforms, so only run it as the main program
+if __name__ == "__main__":
+    # Get the data folder and options from the command line
+    options = [arg for arg in argv[1:] if arg.startswith("--")]
+    folder = io.path_from_input([arg for arg in argv if arg not in options])
+    root = io.find_root_folder(folder)
+    kwargs = {}
+    for option in options:
+        if option.startswith("--output="):
+            kwargs["output"] = option.split("=")[1]
+        elif option.startswith("--steps="):
+            kwargs["steps"] = option.split("=")[1].split(",")
+        elif option.startswith("--workers="):
+            kwargs["workers"] = int(option.split("=")[1])
+        elif option == "--plan":
+            kwargs["use_plan"] = True
+        else:
+            raise ValueError(f"Unknown command-line option `{option}`")
+    output = kwargs.get("output", "RGBG2")
+
+    # Load Camera object
+    camera = io.load_camera(root)
+    print(f"Loaded Camera object: {camera}")
+
+    # Find all RAW files and the filenames to save their calibrated data to
+    files = sorted(folder.glob(f"**/*{camera.raw_extension}"))
+    save_to = [io.replace_word_in_path(file, "images", "calibrated").with_name(f"{file.stem}_{output}.npy") for file in files]
+    print(f"Found {len(files)} RAW images in `{folder}`")
+
+    # Calibrate all images
+    totals, elapsed = batch.calibrate_files(files, save_to, root, **kwargs)
+
+    # Report the throughput and the time spent in each stage
+    print(f"Calibrated {len(files)} images in {elapsed:.1f} s ({len(files)/elapsed:.1f} images/s)")
+    total_time = sum(totals.values())
+    for stage, time in totals.items():
+        print(f"    {stage:>10}: {1000*time/max(len(files), 1):8.1f} ms per image ({100*time/max(total_time, 1e-9):4.1f}%)")
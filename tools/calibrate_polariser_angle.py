@@ -3,6 +3,7 @@ from sys import argv
 from matplotlib import pyplot as plt
 from spectacle import io, raw
 from spectacle.gain import malus
+from spectacle.general import radius_RGBG2
 from scipy.optimize import curve_fit
 
 folder = argv[1]
@@ -23,13 +24,10 @@ def fit(data):
     return popt[1]
 
 
-x = np.arange(means.shape[2])
-y = np.arange(means.shape[1])
-X, Y = np.meshgrid(x, y)
-(x0, y0) = (len(x) / 2, len(y) / 2)
-D = np.sqrt((X - x0)**2 + (Y - y0)**2)
+# Distance of each pixel from the center, split into the RGBG2 channels
+D_split = radius_RGBG2(means.shape[1:], colours)
 
-meanRGBG, stdsRGBG, D_split = raw.demosaick(colours, [mean_reshaped, stds_reshaped, D])
+meanRGBG, stdsRGBG = raw.demosaick(colours, [mean_reshaped, stds_reshaped])
 
 outer_radii = np.arange(1000, 2000, 75)
 
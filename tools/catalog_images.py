@@ -0,0 +1,24 @@
+"""
+Scan a folder of images and store their EXIF metadata (ISO speed, exposure
+time, make, model, black level) in an image catalog. The catalog is saved as
+`spectacle_catalog.sqlite` in the given folder. Running this script again
+only reads images that are new or have changed since the last scan.
+
+The catalog can then be queried in other scripts using
+`spectacle.catalog.load_catalog`, for example:
+    `catalog.query(iso=100, exposure_min=1/1000, exposure_max=1/10)`
+
+Command line arguments:
+    * `folder`: folder containing images, typically the `images` folder.
+    Images in this folder and any of its subfolders are catalogued.
+"""
+
+from sys import argv
+from spectacle import io, catalog
+
+# Get the data folder from the command line
+folder = io.path_from_input(argv)
+
+# Scan the folder and update the catalog
+image_catalog = catalog.load_catalog(folder)
+print(image_catalog)
@@ -7,63 +7,28 @@ structure `level1/level2/level3/image1.dng`, stacks will be generated at
 
 By default, image stacks are saved in the `root/stacks/` folder.
 
-This script is intended for particularly large data sets. For smaller ones,
-use the `stack_mean_std.py` script instead.
+This script is intended for particularly large data sets. It uses the same
+code as the `stack_mean_std.py` script, but with a default memory limit, and
+with the RAW file format taken from the camera information in the root folder.
+If a folder does not fit within the memory limit, its stacks are calculated in
+blocks of rows, using a temporary copy of the decoded images.
 
 Command line arguments:
     * `folder`: folder containing data. Any RAW (and optionally JPEG) images in
     this folder and any of its subfolders will be stacked, as described above.
-
-This script will be merged into `stack_mean_std.py`, so please refer to that
-script for further documentation.
+    * Any of the options of `stack_mean_std.py`. The default memory limit
+    (`--memory=X`) is 4 GB.
 """
 
-import numpy as np
 from sys import argv
-from spectacle import io
-from os import walk, makedirs
+from spectacle import io, stack
 
-folder = io.path_from_input(argv)
+folder = io.path_from_input([arg for arg in argv if not arg.startswith("--")])
 root = io.find_root_folder(folder)
 
 # Load Camera object
 camera = io.load_camera(root)
 print(f"Loaded Camera object: {camera}")
 
-raw_pattern = f"*{camera.raw_extension}"
-
-for tup in walk(folder):
-    folder_here = io.Path(tup[0])
-    goal = io.replace_word_in_path(folder_here, "images", "stacks")
-
-    raw_files = list(folder_here.glob(raw_pattern))
-    if len(raw_files) == 0:
-        continue
-
-    arrs = io.load_raw_image_multi(folder_here, pattern=raw_pattern)
-    mean = np.full(arrs.shape[1:], np.nan)
-    stds = mean.copy()
-    for i, row in enumerate(mean):
-        mean[i] = arrs[:,i].mean(axis=0, dtype=np.float32)
-        stds[i] = arrs[:,i].std (axis=0, dtype=np.float32)
-        if not i%100:
-            print(f"{i/len(mean)*100:.1f}%")
-    del arrs
-
-    makedirs(goal.parent, exist_ok=True)
-
-    np.save(f"{goal}_mean.npy", mean)
-    np.save(f"{goal}_stds.npy", stds)
-
-    print(f"{folder_here}  -->  {goal}_x.npy")
-
-    JPGs = list(folder_here.glob("*.jp*g"))
-    if len(JPGs) == 0:
-        continue
-
-    jarrs = io.load_jpg_multi(folder_here)
-    jmean = jarrs.mean(axis=0, dtype=np.float32)
-    jstds = jarrs.std (axis=0, dtype=np.float32)
-
-    np.save(f"{goal}_jmean.npy", jmean)
-    np.save(f"{goal}_jstds.npy", jstds)
+# Stack all folders, using the options given on the command line
+stack.stack_command_line(argv, raw_patterns=[f"*{camera.raw_extension}"], memory_limit=4e9)
@@ -0,0 +1,75 @@
+"""
+Combine the NPY stacks in a folder into a single stack container file. This
+script will walk through all the subfolders of a given folder and add every
+`X_mean.npy` / `X_stds.npy` pair it finds to the container, together with the
+ISO speed, exposure time, and polariser angle parsed from its filename where
+possible. If there are JPEG stacks (`X_jmean.npy` / `X_jstds.npy`) for every
+RAW stack, these are added to the container too. Values are parsed from the filename first, then from the names
+of its parent folders, e.g. `iso100/t1_1000_mean.npy`.
+
+The container is saved next to the folder, e.g. for a folder
+`stacks/linearity` the container is saved at `stacks/linearity.stack`.
+It can then be used in place of the folder in `io.load_means`,
+`io.load_jmeans`, and similar functions.
+
+Command line arguments:
+    * `folder`: folder containing NPY stacks.
+"""
+
+import numpy as np
+from sys import argv
+from spectacle import io, container
+
+# Get the data folder from the command line
+folder = io.path_from_input(argv)
+save_to = folder.with_suffix(container.suffix)
+
+# Find all mean stacks in this folder and its subfolders
+meanfiles = sorted(folder.glob("**/*_mean.npy"))
+labels = [str(file.relative_to(folder)).replace("_mean.npy", "") for file in meanfiles]
+print(f"Found {len(labels)} stacks in `{folder}`")
+
+
+def try_split(split_func, path):
+    """
+    Retrieve a value from a path using `split_func`, trying the filename first
+    and then its parent folders (within `folder`). Return NaN if this fails.
+    """
+    relative_path = path.relative_to(folder)
+    for part in [relative_path, *list(relative_path.parents)[:-1]]:
+        try:
+            return split_func(part)
+        except (ValueError, IndexError):
+            continue
+    return np.nan
+
+
+# Build the metadata table from the filenames
+metadata = {"label": labels,
+            "iso": [try_split(io.split_iso, file) for file in meanfiles],
+            "exposure_time": [try_split(io.split_exposure_time, file) for file in meanfiles],
+            "pol_angle": [try_split(io.split_pol_angle, file) for file in meanfiles]}
+
+datasets = dict(container.default_datasets)
+frame_shapes = {}
+
+# Include the JPEG stacks if they exist for every RAW stack; these have a different shape
+jmeanfiles = [folder/f"{label}_jmean.npy" for label in labels]
+if all(file.exists() for file in jmeanfiles):
+    jpeg_shape = io.load_npy_shape(jmeanfiles[0])
+    datasets.update({"jmean": "float32", "jstds": "float32"})
+    frame_shapes.update({"jmean": jpeg_shape, "jstds": jpeg_shape})
+    print("Found JPEG stacks for every RAW stack")
+
+# Create the container, using the first RAW stack to determine the shape
+frame_shape = io.load_npy_shape(meanfiles[0])
+stack_container = container.StackContainer.create(save_to, frame_shape, metadata, datasets=datasets, frame_shapes=frame_shapes)
+
+# Add the stacks to the container one at a time
+for j, label in enumerate(labels):
+    for name in datasets:
+        stack_container.write(name, j, np.load(folder/f"{label}_{name}.npy"))
+    print(f"{folder/label}  -->  {save_to} [{j}]")
+
+stack_container.flush()
+print(f"Saved stack container to `{save_to}`")